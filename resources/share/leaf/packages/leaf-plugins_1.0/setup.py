@@ -16,7 +16,7 @@ from leaf.cli.completion import complete_available_packages
 from leaf.cli.plugins import LeafPluginCommand
 from leaf.core.constants import LeafSettings
 from leaf.core.error import InvalidPackageNameException, LeafException
-from leaf.model.modelutils import group_package_identifiers_by_name
+from leaf.model.modelutils import PackageCatalog
 from leaf.model.package import PackageIdentifier
 from leaf.model.workspace import Profile
 
@@ -108,20 +108,19 @@ class LeafCommandGenerator:
 
 def resolve_latest(motif_list, pm):
     out = []
-    grouped_packages = {}
-    group_package_identifiers_by_name(pm.list_installed_packages().keys(), pkgmap=grouped_packages)
-    group_package_identifiers_by_name(pm.list_available_packages().keys(), pkgmap=grouped_packages)
+    catalog = PackageCatalog(pm.list_available_packages())
+    catalog.update(pm.list_installed_packages())
 
     for motif in motif_list:
         pi = None
         if PackageIdentifier.is_valid_identifier(motif):
             pi = PackageIdentifier.parse(motif)
-            if pi.name not in grouped_packages or pi not in grouped_packages[pi.name]:
+            if pi not in catalog:
                 # Unknwon package
                 pi = None
-        elif motif in grouped_packages:
-            # Get latest of the sorted list
-            pi = grouped_packages[motif][-1]
+        else:
+            # Get latest version
+            pi = catalog.latest(motif)
 
         # Check if package identifier has been found
         if pi is None:
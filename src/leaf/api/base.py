@@ -11,18 +11,20 @@ import operator
 import os
 import platform
 from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from leaf import __version__
 from leaf.core.constants import LeafFiles, LeafSettings
 from leaf.core.error import LeafException, UserCancelException
+from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.core.logger import TextLogger, print_trace
-from leaf.core.utils import is_folder_ignored
+from leaf.core.utils import fs_get_identity, fs_is_racy, is_folder_ignored
 from leaf.model.base import Scope
 from leaf.model.config import ConfigContextManager, UserConfiguration
 from leaf.model.environment import Environment
-from leaf.model.modelutils import keep_latest
+from leaf.model.modelutils import PackageCatalog, keep_latest
 from leaf.model.package import InstalledPackage, ScopeSetting
 from leaf.rendering.renderer.error import HintsRenderer, LeafExceptionRenderer
 from leaf.rendering.renderer.question import QuestionRenderer
@@ -30,6 +32,58 @@ from leaf.rendering.theme import ThemeManager
 
 
 class ConfigurationManager:
+
+    """
+    Give access to the user configuration and to the installed packages.
+    Installed packages are listed from an index kept in the cache folder: a root folder is only listed again
+    if its identity changed, a manifest is only read again if its folder or itself has been modified.
+    Within a model_cache block, listed packages are also kept in memory
+    """
+
+    __INDEX_ROOT = "root"
+    __INDEX_PACKAGES = "packages"
+    __INDEX_IDENTITY = "identity"
+    __INDEX_MANIFEST = "manifest"
+    _MODEL_INSTALLED = "installed"
+    _MODEL_AVAILABLE = "available"
+
+    def __init__(self):
+        self.__model_cache = None
+
+    @contextmanager
+    def model_cache(self):
+        """
+        Keep the installed and available packages in memory during the block, for example for the duration of a command.
+        Parts of the cache are invalidated when packages are installed or removed, or when remotes change
+        """
+        if self.__model_cache is not None:
+            # Nested block, keep the cache of the enclosing one
+            yield
+            return
+        self.__model_cache = {}
+        try:
+            yield
+        finally:
+            self.__model_cache = None
+
+    def _get_cached_model(self, kind: str, key, builder: callable):
+        """
+        Return the model built by builder, from the cache if a model cache block is active
+        The returned object is shared, it must not be modified
+        """
+        cache = self.__model_cache
+        if cache is None:
+            return builder()
+        if (kind, key) not in cache:
+            cache[(kind, key)] = builder()
+        return cache[(kind, key)]
+
+    def _invalidate_model_cache(self, kind: str):
+        cache = self.__model_cache
+        if cache is not None:
+            for key in [k for k in list(cache) if k[0] == kind]:
+                cache.pop(key, None)
+
     @property
     def configuration_folder(self):
         out = LeafSettings.CONFIG_FOLDER.as_path()
@@ -106,35 +160,68 @@ class ConfigurationManager:
         with self.open_user_configuration() as config:
             config.update_environment(set_map, unset_list)
 
-    def _list_installed_packages(self, root_folder: Path, read_only: bool) -> dict:
+    def __load_installed_index(self) -> dict:
+        indexfile = self.cache_folder / LeafFiles.CACHE_INSTALLED_INDEX_FILENAME
+        if indexfile.exists():
+            try:
+                return jloadfile(indexfile)
+            except Exception:
+                print_trace("Invalid installed packages index {file}, scan the package folders".format(file=indexfile))
+        return {}
+
+    def __save_installed_index(self, index: dict):
+        # The index may be written concurrently by several threads or processes
+        jwritefile(self.cache_folder / LeafFiles.CACHE_INSTALLED_INDEX_FILENAME, index, atomic=True)
+
+    def _list_installed_packages(self, root_folder: Path, read_only: bool, index: dict = None) -> dict:
         """
         Return all installed packages in given folder
+        If an index is given, manifests of unchanged package folders are read from it, and the index is updated
         @return: PackageIdentifier/InstalledPackage dict
         """
         out = {}
         if root_folder is not None and root_folder.is_dir():
-            for folder in root_folder.iterdir():
+            entry = index.get(str(root_folder)) if index is not None else None
+            known = entry[ConfigurationManager.__INDEX_PACKAGES] if entry is not None else {}
+            root_identity = fs_get_identity(root_folder)
+            if entry is not None and entry.get(ConfigurationManager.__INDEX_ROOT) == root_identity:
+                # No package has been installed nor removed
+                folders = [root_folder / name for name in known]
+            else:
                 # iterate over non ignored sub folders
-                if folder.is_dir() and not is_folder_ignored(folder):
-                    # test if a manifest exists
-                    mffile = folder / LeafFiles.MANIFEST
-                    if mffile.is_file():
-                        try:
-                            ip = InstalledPackage(mffile, read_only=read_only)
-                            out[ip.identifier] = ip
-                        except BaseException:
-                            print_trace("Invalid manifest found: {mf}".format(mf=mffile))
+                folders = [folder for folder in root_folder.iterdir() if folder.is_dir() and not is_folder_ignored(folder)]
+            racy = fs_is_racy(root_identity)
+            packages = OrderedDict()
+            for folder in folders:
+                # test if a manifest exists
+                mffile = folder / LeafFiles.MANIFEST
+                if mffile.is_file():
+                    try:
+                        identity = [fs_get_identity(folder), fs_get_identity(mffile)]
+                        cached = known.get(folder.name)
+                        if cached is not None and cached[ConfigurationManager.__INDEX_IDENTITY] == identity:
+                            json = cached[ConfigurationManager.__INDEX_MANIFEST]
+                        else:
+                            json = jloadfile(mffile)
+                        ip = InstalledPackage(mffile, read_only=read_only, json=json)
+                        out[ip.identifier] = ip
+                        if any(fs_is_racy(i) for i in identity):
+                            racy = True
+                        else:
+                            packages[folder.name] = {ConfigurationManager.__INDEX_IDENTITY: identity, ConfigurationManager.__INDEX_MANIFEST: json}
+                    except BaseException:
+                        print_trace("Invalid manifest found: {mf}".format(mf=mffile))
+            if index is not None:
+                # If the folder may have changed since the scan, it will be listed again next time
+                index[str(root_folder)] = {ConfigurationManager.__INDEX_ROOT: None if racy else root_identity, ConfigurationManager.__INDEX_PACKAGES: packages}
         return out
 
-    def list_installed_packages(self, only_latest=False, alt_user_root_folder: Path = None) -> dict:
-        out = {}
-        # Scan readonly system folder
-        if LeafSettings.SYSTEM_PKG_FOLDERS.as_boolean():
-            for system_root in LeafSettings.SYSTEM_PKG_FOLDERS.value.split(os.pathsep):
-                out.update(self._list_installed_packages(Path(os.path.expanduser(system_root)), True))
-
-        # Scan user root folder
-        out.update(self._list_installed_packages(alt_user_root_folder or self.install_folder, False))
+    def list_installed_packages(self, only_latest=False, alt_user_root_folder: Path = None) -> PackageCatalog:
+        out = dict(
+            self._get_cached_model(
+                ConfigurationManager._MODEL_INSTALLED, alt_user_root_folder, lambda: self.__scan_installed_packages(alt_user_root_folder=alt_user_root_folder)
+            )
+        )
 
         # only keep latest if needed
         if only_latest:
@@ -142,7 +229,23 @@ class ConfigurationManager:
             out = {pi: ip for pi, ip in out.items() if pi in latest_pi_list}
 
         # sort dict by package identifier
-        return OrderedDict(sorted(out.items(), key=operator.itemgetter(0)))
+        return PackageCatalog(sorted(out.items(), key=operator.itemgetter(0)))
+
+    def __scan_installed_packages(self, alt_user_root_folder: Path = None) -> dict:
+        out = {}
+        previous_index = self.__load_installed_index()
+        # Forget removed folders, like deleted profiles
+        index = {root: entry for root, entry in previous_index.items() if Path(root).is_dir()}
+        # Scan readonly system folder
+        if LeafSettings.SYSTEM_PKG_FOLDERS.as_boolean():
+            for system_root in LeafSettings.SYSTEM_PKG_FOLDERS.value.split(os.pathsep):
+                out.update(self._list_installed_packages(Path(os.path.expanduser(system_root)), True, index=index))
+
+        # Scan user root folder
+        out.update(self._list_installed_packages(alt_user_root_folder or self.install_folder, False, index=index))
+        if index != previous_index:
+            self.__save_installed_index(index)
+        return out
 
     def get_setting(self, setting_id: str) -> ScopeSetting:
         out = self.get_settings().get(setting_id)
@@ -7,25 +7,59 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
-import shutil
+import os
+import tarfile
+import time
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 from tarfile import TarFile
+from threading import Event, Lock
+from urllib.parse import urlparse
 
 from leaf.api.remotes import RemoteManager
+from leaf.core.cache import ArtifactCache
 from leaf.core.constants import LeafConstants, LeafFiles, LeafSettings
-from leaf.core.download import download_and_verify_file
-from leaf.core.error import InvalidPackageNameException, LeafException, LeafOutOfDateException, NoPackagesInCacheException, PrereqException
+from leaf.core.download import DownloadProgress, download_and_stream_file, download_and_verify_file
+from leaf.core.error import (
+    DownloadCancelledException,
+    InvalidHashException,
+    InvalidPackageNameException,
+    LeafException,
+    LeafOutOfDateException,
+    NoPackagesInCacheException,
+    PrereqException,
+)
 from leaf.core.lock import LockFile
-from leaf.core.utils import fs_check_free_space, fs_compute_total_size, get_cached_artifact_name, mark_folder_as_ignored, rmtree_force
+from leaf.core.logger import BufferedLogger, TextLogger, print_trace
+from leaf.core.utils import fs_check_free_space, mark_folder_as_ignored, rmtree_force
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
-from leaf.model.modelutils import check_leaf_min_version, find_manifest, is_latest_package
+from leaf.model.modelutils import PackageCatalog, check_leaf_min_version, find_manifest, is_latest_package
 from leaf.model.package import IDENTIFIER_GETTER, AvailablePackage, InstalledPackage, LeafArtifact, PackageIdentifier
 from leaf.model.steps import StepExecutor, VariableResolver
 from leaf.rendering.formatutils import sizeof_fmt
 
 
+def _check_tar_member(member: tarfile.TarInfo) -> tarfile.TarInfo:
+    """
+    Refuse members which would be extracted outside the destination folder: absolute paths, '..',
+    links pointing outside the folder, and devices
+    """
+
+    def is_outside(path: str):
+        return os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == ".."
+
+    target = None
+    if member.issym():
+        target = os.path.join(os.path.dirname(member.name), member.linkname)
+    elif member.islnk():
+        target = member.linkname
+    if is_outside(member.name) or (target is not None and (os.path.isabs(member.linkname) or is_outside(target))) or member.isdev():
+        raise LeafException("Refuse to extract {member.name} outside the destination folder".format(member=member))
+    return member
+
+
 class PackageManager(RemoteManager):
 
     """
@@ -38,6 +72,11 @@ class PackageManager(RemoteManager):
         """
         RemoteManager.__init__(self)
         self.__download_cache_folder = self.cache_folder / LeafFiles.CACHE_DOWNLOAD_FOLDERNAME
+        self.__download_cache = ArtifactCache(
+            self.__download_cache_folder,
+            self.cache_folder / LeafFiles.CACHE_DOWNLOAD_LEDGER_FILENAME,
+            self.cache_folder / LeafFiles.CACHE_LOCKS_FOLDERNAME,
+        )
         self.__application_lock = LockFile(self.find_configuration_file(LeafFiles.LOCK_FILENAME))
         self.__check_cache_folder_size()
 
@@ -50,27 +89,40 @@ class PackageManager(RemoteManager):
         self.__download_cache_folder.mkdir(parents=True, exist_ok=True)
         return self.__download_cache_folder
 
+    @property
+    def download_cache(self) -> ArtifactCache:
+        return self.__download_cache
+
     def __check_cache_folder_size(self):
         # Check if it has been checked recently
         if self.is_file_outdated(self.download_cache_folder):
-            # Compute the folder total size
-            totalsize = fs_compute_total_size(self.download_cache_folder)
+            # The total size is read from the cache ledger
+            totalsize = self.download_cache.get_total_size()
             if totalsize > LeafConstants.CACHE_SIZE_MAX:
                 # Display a message
                 self.logger.print_error("You can save {size} by cleaning the leaf cache folder".format(size=sizeof_fmt(totalsize)))
-                self.print_hints("to clean the cache, you can run: 'rm -r {folder}'".format(folder=self.download_cache_folder))
-                # Clean the cache
-                if not LeafSettings.NON_INTERACTIVE.as_boolean() and LeafSettings.CACHE_AUTOCLEAN.as_boolean():
-                    if self.print_with_confirm(question="Do you want to clean the cache?"):
-                        shutil.rmtree(str(self.download_cache_folder))
-                # Update the mtime
-                self.download_cache_folder.touch()
-
-    def list_available_packages(self, force_refresh=False) -> dict:
+                self.print_hints("to clean the cache, you can run: 'leaf cache prune'")
+                # Evict the least recently used artifacts, without confirmation in non interactive mode
+                if LeafSettings.CACHE_AUTOCLEAN.as_boolean():
+                    if LeafSettings.NON_INTERACTIVE.as_boolean() or self.print_with_confirm(question="Do you want to remove the least recently used files?"):
+                        evicted = self.download_cache.evict(LeafConstants.CACHE_SIZE_TARGET)
+                        self.logger.print_default("{count} file(s) removed from the leaf cache folder".format(count=len(evicted)))
+            # Remove interrupted downloads which have not been resumed for a long time
+            for file in self.download_cache.prune_partial_files():
+                self.logger.print_verbose("Remove stale partial file {file}".format(file=file))
+            # Update the mtime
+            self.download_cache_folder.touch()
+
+    def list_available_packages(self, force_refresh=False) -> PackageCatalog:
         """
         List all available package
         """
-        out = OrderedDict()
+        if force_refresh:
+            self._invalidate_model_cache(self._MODEL_AVAILABLE)
+        return PackageCatalog(self._get_cached_model(self._MODEL_AVAILABLE, None, lambda: self.__build_available_packages(force_refresh)))
+
+    def __build_available_packages(self, force_refresh: bool) -> dict:
+        out = PackageCatalog()
         self.fetch_remotes(force_refresh=force_refresh)
 
         for remote in self.list_remotes(only_enabled=True).values():
@@ -95,23 +147,169 @@ class PackageManager(RemoteManager):
             raise NoPackagesInCacheException()
         return out
 
-    def __download_ap(self, ap: AvailablePackage) -> LeafArtifact:
+    def __get_cached_file(self, ap: AvailablePackage) -> Path:
+        return self.__download_cache.get_file(ap.filename, ap.hashsum)
+
+    def __get_staging_folder(self, pi: PackageIdentifier) -> Path:
+        return self.install_folder / LeafFiles.STAGING_FOLDERNAME / str(pi)
+
+    def __clean_staging_folders(self):
+        staging_root = self.install_folder / LeafFiles.STAGING_FOLDERNAME
+        if staging_root.exists():
+            self.logger.print_verbose("Remove staging folder: {folder}".format(folder=staging_root))
+            rmtree_force(staging_root)
+
+    def __stream_ap(self, ap: AvailablePackage, url: str, progress: callable = None, cancel: Event = None) -> bool:
+        """
+        Download the artifact and extract it in its staging folder at the same time
+        The staging folder is kept only if the artifact hash is verified
+        @return: True if the artifact has been downloaded and staged, False if a regular download is needed
+        """
+        cachedfile = self.__get_cached_file(ap)
+        staging_folder = self.__get_staging_folder(ap.identifier)
+        if staging_folder.exists():
+            rmtree_force(staging_folder)
+        staging_folder.mkdir(parents=True)
+
+        def extract(stream):
+            # The content is extracted before it is verified, it must not be written outside the staging folder
+            with TarFile.open(fileobj=stream, mode="r|*") as tf:
+                if hasattr(tarfile, "data_filter"):
+                    tf.extractall(str(staging_folder), filter="data")
+                else:
+                    for member in tf:
+                        tf.extract(_check_tar_member(member), str(staging_folder))
+
+        try:
+            download_and_stream_file(url, cachedfile, extract, logger=self.logger, hashstr=ap.best_hashsum, progress=progress, cancel=cancel)
+            return True
+        except (DownloadCancelledException, InvalidHashException) as e:
+            rmtree_force(staging_folder)
+            raise e
+        except Exception:
+            print_trace()
+            self.logger.print_verbose("Cannot extract {ap.identifier} while downloading, use a regular download".format(ap=ap))
+            # The partial file has no journal, the regular download starts from the beginning
+            rmtree_force(staging_folder)
+            return False
+
+    def __download_ap(self, ap: AvailablePackage, progress: callable = None, cancel: Event = None) -> LeafArtifact:
         """
         Download given available package and returns the files in cache folder
+        Candidates are tried from the fastest healthy remote, falling back to the next one on error
+        The artifact is locked while it is downloaded, so that other leaf processes sharing the cache
+        wait for it and reuse the verified file
         @return LeafArtifact
         """
-        cachedfile = self.__download_cache_folder / get_cached_artifact_name(ap.filename, ap.hashsum)
-        # Select best candidate
-        candidate = ap.best_candidate
-        self.logger.print_verbose("Downloading {ap.identifier} from {ap.remote.alias}: {ap.url}".format(ap=candidate))
-        download_and_verify_file(candidate.url, cachedfile, logger=self.logger, hashstr=ap.hashsum)
-        return LeafArtifact(cachedfile)
-
-    def __extract_artifact(self, la: LeafArtifact, env: Environment, ipmap: dict, keep_folder_on_error: bool = False) -> InstalledPackage:
+        if progress is None:
+            # Display the progress of this download only, like for prereq packages
+            display = DownloadProgress(self.logger, "Downloading {ap.filename}".format(ap=ap))
+            try:
+                return self.__download_ap(ap, progress=display.create(ap.identifier, ap.size), cancel=cancel)
+            finally:
+                display.end()
+
+        cachedfile = self.__get_cached_file(ap)
+
+        def on_wait():
+            self.logger.print_verbose("Wait for another leaf process downloading {ap.identifier}".format(ap=ap))
+
+        with self.__download_cache.lock(cachedfile, on_wait=on_wait):
+            candidates = self.sort_candidates(ap.candidates, size=ap.size)
+            failed_urls = []
+            for index, candidate in enumerate(candidates):
+                is_last = index == len(candidates) - 1
+                cached = cachedfile.exists()
+                # Do not hash the cached artifact again if it did not change since its last verification
+                trusted = cached and not LeafSettings.CACHE_VERIFY.as_boolean() and self.__download_cache.is_verified(cachedfile, ap.best_hashsum)
+                start = time.time()
+                latency = []
+
+                def track_progress(worked, total, start=start, latency=latency):
+                    # Latency is the time until the first bytes are received
+                    if worked > 0 and len(latency) == 0:
+                        latency.append(time.time() - start)
+                    progress(worked, total)
+
+                self.logger.print_verbose("Downloading {ap.identifier} from {ap.remote.alias}: {ap.url}".format(ap=candidate))
+                # Streaming is only possible for http(s) urls, and if the hash can be verified before installation
+                stream = LeafSettings.DOWNLOAD_STREAM.as_boolean() and not cached and ap.best_hashsum is not None and urlparse(candidate.url).scheme.startswith("http")
+                try:
+                    if not stream or not self.__stream_ap(ap, candidate.url, progress=track_progress, cancel=cancel):
+                        download_and_verify_file(
+                            candidate.url,
+                            cachedfile,
+                            logger=self.logger,
+                            hashstr=ap.best_hashsum,
+                            progress=track_progress,
+                            cancel=cancel,
+                            # Do not spread ranges over the remotes which already failed
+                            mirrors=[c.url for c in candidates if c.url not in failed_urls],
+                            size=ap.size,
+                            # Do not wait for the whole retry budget if another remote can be used
+                            retry=None if is_last else min(1, LeafSettings.DOWNLOAD_RETRY.as_int()),
+                            trusted=trusted,
+                        )
+                except DownloadCancelledException:
+                    raise
+                except Exception as e:
+                    self.update_remote_stats(candidate.remote, failed=True)
+                    failed_urls.append(candidate.url)
+                    if is_last:
+                        raise e
+                    print_trace()
+                    self.logger.print_default("")
+                    self.logger.print_default("Cannot download {ap.identifier} from {ap.remote.alias}, try another remote".format(ap=candidate))
+                    continue
+                if not cached:
+                    self.update_remote_stats(
+                        candidate.remote, size=cachedfile.stat().st_size, elapsed=time.time() - start, latency=latency[0] if latency else None
+                    )
+                # The artifact has been verified, if it has a hash
+                self.__download_cache.touch(cachedfile, hashstr=ap.best_hashsum)
+                return LeafArtifact(cachedfile)
+
+    def __download_ap_list(self, aplist: list) -> list:
+        """
+        Download given available packages using a bounded pool of workers.
+        If a download fails, pending downloads are cancelled, partially downloaded files are kept to be resumed
+        @return LeafArtifact list, in the same order as given available packages
+        """
+        workers = min(LeafSettings.DOWNLOAD_WORKERS.as_int(), len(aplist))
+        if workers <= 1:
+            out = []
+            for ap in aplist:
+                out.append(self.__download_ap(ap))
+            return out
+
+        cancel = Event()
+        progress = DownloadProgress(self.logger, "Downloading {count} package(s)".format(count=len(aplist)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.__download_ap, ap, progress=progress.create(ap.identifier, ap.size), cancel=cancel) for ap in aplist]
+            try:
+                # Fail fast, raise the first error
+                for future in as_completed(futures):
+                    future.result()
+                progress.end()
+            except BaseException as e:
+                cancel.set()
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                progress.end()
+                self.logger.print_verbose("Error while downloading packages, pending downloads cancelled")
+                # Cached files are only created once verified, partial downloads will be resumed
+                raise e
+        return [future.result() for future in futures]
+
+    def __extract_artifact(
+        self, la: LeafArtifact, env: Environment, ipmap: dict, keep_folder_on_error: bool = False, logger: TextLogger = None
+    ) -> InstalledPackage:
         """
         Install a leaf artifact
         @return InstalledPackage
         """
+        logger = logger or self.logger
         if la.identifier in ipmap:
             raise LeafException("Package is already installed: {la.identifier}".format(la=la))
 
@@ -124,31 +322,120 @@ class PackageManager(RemoteManager):
         if min_version:
             raise LeafOutOfDateException("You need to upgrade leaf to v{version} to install {la.identifier}".format(version=min_version, la=la))
 
-        # Create folder
-        target_folder.mkdir(parents=True)
+        # Create folder, or promote the content extracted while downloading
+        staging_folder = self.__get_staging_folder(la.identifier)
+        staged = staging_folder.is_dir()
+        if staged:
+            logger.print_verbose("Move {src} to {dest}".format(src=staging_folder, dest=target_folder))
+            staging_folder.rename(target_folder)
+        else:
+            target_folder.mkdir(parents=True)
+        self._invalidate_model_cache(self._MODEL_INSTALLED)
 
         try:
             # Extract content
-            self.logger.print_verbose("Extract {la.path} in {dest}".format(la=la, dest=target_folder))
-            with TarFile.open(str(la.path)) as tf:
-                tf.extractall(str(target_folder))
+            if not staged:
+                logger.print_verbose("Extract {la.path} in {dest}".format(la=la, dest=target_folder))
+                with TarFile.open(str(la.path)) as tf:
+                    tf.extractall(str(target_folder))
             # Execute post install steps
             out = InstalledPackage(target_folder / LeafFiles.MANIFEST)
             ipmap[out.identifier] = out
-            self.__execute_steps(out.identifier, ipmap, StepExecutor.install, env=env)
+            self.__execute_steps(out.identifier, ipmap, StepExecutor.install, env=env, logger=logger)
             # Touch folder to trigger FS event
             target_folder.touch(exist_ok=True)
             return out
         except BaseException as e:
-            self.logger.print_error("Error during installation:", e)
+            logger.print_error("Error during installation:", e)
             if keep_folder_on_error:
                 target_folder = mark_folder_as_ignored(target_folder)
-                self.logger.print_verbose("Mark folder as ignored: {folder}".format(folder=target_folder))
+                logger.print_verbose("Mark folder as ignored: {folder}".format(folder=target_folder))
             else:
-                self.logger.print_verbose("Remove folder: {folder}".format(folder=target_folder))
+                logger.print_verbose("Remove folder: {folder}".format(folder=target_folder))
                 rmtree_force(target_folder)
             raise e
 
+    def __install_la_list(self, la_to_install: list, env: Environment, ipmap: dict, keep_folder_on_error: bool = False) -> list:
+        """
+        Extract given artifacts and run their install steps.
+        Packages are installed concurrently using a bounded pool of workers, a package being installed only once
+        all its dependencies are installed. The output of each package is printed in install order.
+        If an installation fails, no other package is started and the error is raised once running ones are done.
+        @return InstalledPackage list, in the same order as given artifacts
+        """
+
+        def header(index, la):
+            return "[{current}/{total}] Installing {la.identifier}".format(current=index + 1, total=len(la_to_install), la=la)
+
+        workers = min(LeafSettings.INSTALL_WORKERS.as_int(), len(la_to_install))
+        if workers <= 1:
+            out = []
+            for index, la in enumerate(la_to_install):
+                self.logger.print_default(header(index, la))
+                out.append(self.__extract_artifact(la, env, ipmap, keep_folder_on_error=keep_folder_on_error))
+            return out
+
+        # Only keep dependencies between the packages to install, others are already installed.
+        # Packages are sorted in install order, so only keep edges to previous packages to build a DAG
+        lamap = OrderedDict((la.identifier, la) for la in la_to_install)
+        pilist = list(lamap)
+        depends = {}
+        for index, la in enumerate(la_to_install):
+            depends[la.identifier] = set()
+            for cpi in la.get_depends_from_env(env):
+                dep = find_manifest(cpi, lamap, ignore_unknown=True)
+                if dep is not None and pilist.index(dep.identifier) < index:
+                    depends[la.identifier].add(dep.identifier)
+
+        loggers = OrderedDict((pi, BufferedLogger()) for pi in lamap)
+        ipmap_lock = Lock()
+
+        def install(la, logger):
+            # Work on a copy of installed packages, which contains all dependencies of the package
+            with ipmap_lock:
+                local_ipmap = dict(ipmap)
+            # Do not alter the shared environment
+            ip = self.__extract_artifact(la, Environment.build(env), local_ipmap, keep_folder_on_error=keep_folder_on_error, logger=logger)
+            with ipmap_lock:
+                ipmap[ip.identifier] = ip
+            return ip
+
+        pending = list(lamap)
+        running = {}
+        finished = []
+        results = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                if error is None:
+                    for pi in [pi for pi in pending if depends[pi].issubset(results)]:
+                        pending.remove(pi)
+                        loggers[pi].print_default(header(pilist.index(pi), lamap[pi]))
+                        running[executor.submit(install, lamap[pi], loggers[pi])] = pi
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pi = running.pop(future)
+                    finished.append(pi)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        results[pi] = future.result()
+                # Print the output of finished packages, in install order
+                for pi in list(loggers):
+                    if pi not in finished:
+                        break
+                    loggers.pop(pi).flush()
+
+        # Print the output of remaining packages which have been started
+        for pi, logger in loggers.items():
+            if pi in finished:
+                logger.flush()
+        if error is not None:
+            raise error
+        return [results[pi] for pi in pilist]
+
     def __install_prereq(self, mflist: list, ipmap: dict, env: Environment = None, keep_folder_on_error: bool = False):
         """
         Install given prereg packages and sync them after
@@ -183,99 +470,110 @@ class PackageManager(RemoteManager):
         Compute dependency tree, check compatibility, download from remotes and extract needed packages
         @return: InstalledPackage list
         """
-        with self.application_lock.acquire():
-            ipmap = self.list_installed_packages()
-            apmap = self.list_available_packages()
-            pilist = []
-            for item in items:
-                if isinstance(item, PackageIdentifier):
-                    # Package identifier is given
-                    pilist.append(item)
-                elif PackageIdentifier.is_valid_identifier(item):
-                    # Package identifier string given
-                    pilist.append(PackageIdentifier.parse(item))
-                else:
-                    # If leaf artifacts are given, add/replace identifiers of available packages
-                    la = LeafArtifact(Path(item))
-                    pilist.append(la.identifier)
-                    apmap[la.identifier] = la
-            out = []
-
-            # Build env to resolve dynamic dependencies
-            if env is None:
-                env = Environment.build(self.build_builtin_environment(), self.build_user_environment())
-
-            ap_to_install = DependencyUtils.install(pilist, apmap, ipmap, env=env)
-
-            # Check leaf min version
-            min_version = check_leaf_min_version(ap_to_install)
-            if min_version:
-                raise LeafOutOfDateException(
-                    "You need to upgrade leaf to v{version} to install {text}".format(
-                        version=min_version, text=", ".join([str(ap.identifier) for ap in ap_to_install])
-                    )
-                )
-
-            # Check nothing to do
-            if len(ap_to_install) == 0:
-                self.logger.print_default("All packages are installed")
-            else:
-                # Check available size
-                download_totalsize = 0
-                download_count = 0
-                for ap in [ap for ap in ap_to_install if isinstance(ap, AvailablePackage)]:
-                    download_count += 1
-                    if ap.size is not None:
-                        download_totalsize += ap.size
-                fs_check_free_space(self.download_cache_folder, download_totalsize)
-
-                # Confirm
-                text = ", ".join([str(ap.identifier) for ap in ap_to_install])
-                self.logger.print_quiet("Packages to install: {packages}".format(packages=text))
-                if download_totalsize > 0:
-                    self.logger.print_default("Total size:", sizeof_fmt(download_totalsize))
-                self.print_with_confirm(raise_on_decline=True)
-
-                # Install prereq
-                prereq_to_install = DependencyUtils.prereq([ap.identifier for ap in ap_to_install], apmap, ipmap, env=env)
-
-                if len(prereq_to_install) > 0:
-                    try:
-                        self.__install_prereq(prereq_to_install, ipmap, env=env, keep_folder_on_error=keep_folder_on_error)
-                    except BaseException as e:
-                        raise PrereqException(e)
-
-                # Download ap list
-                self.logger.print_default("Downloading {size} package(s)".format(size=download_count))
-                la_to_install = []
-                for mf in ap_to_install:
-                    if isinstance(mf, AvailablePackage):
-                        la_to_install.append(self.__download_ap(mf))
-                    elif isinstance(mf, LeafArtifact):
-                        la_to_install.append(mf)
-
-                # Check the extracted size
-                extracted_totalsize = 0
-                for la in la_to_install:
-                    if la.final_size is not None:
-                        extracted_totalsize += la.final_size
+        with self.application_lock.acquire(), self.model_cache():
+            # Discard content staged by an interrupted installation
+            self.__clean_staging_folders()
+            try:
+                ipmap = self.list_installed_packages()
+                apmap = self.list_available_packages()
+                pilist = []
+                for item in items:
+                    if isinstance(item, PackageIdentifier):
+                        # Package identifier is given
+                        pilist.append(item)
+                    elif PackageIdentifier.is_valid_identifier(item):
+                        # Package identifier string given
+                        pilist.append(PackageIdentifier.parse(item))
                     else:
-                        extracted_totalsize += la.get_total_size()
-                fs_check_free_space(self.install_folder, extracted_totalsize)
-
-                # Extract la list
-                for la in la_to_install:
-                    self.logger.print_default("[{current}/{total}] Installing {la.identifier}".format(current=(len(out) + 1), total=len(la_to_install), la=la))
-                    ip = self.__extract_artifact(la, env, ipmap, keep_folder_on_error=keep_folder_on_error)
-                    out.append(ip)
+                        # If leaf artifacts are given, add/replace identifiers of available packages
+                        la = LeafArtifact(Path(item))
+                        pilist.append(la.identifier)
+                        apmap[la.identifier] = la
+                out = []
+
+                # Build env to resolve dynamic dependencies
+                if env is None:
+                    env = Environment.build(self.build_builtin_environment(), self.build_user_environment())
+
+                ap_to_install = DependencyUtils.install(pilist, apmap, ipmap, env=env)
+
+                # Check leaf min version
+                min_version = check_leaf_min_version(ap_to_install)
+                if min_version:
+                    raise LeafOutOfDateException(
+                        "You need to upgrade leaf to v{version} to install {text}".format(
+                            version=min_version, text=", ".join([str(ap.identifier) for ap in ap_to_install])
+                        )
+                    )
 
-            return out
+                # Check nothing to do
+                if len(ap_to_install) == 0:
+                    self.logger.print_default("All packages are installed")
+                else:
+                    # Check available size
+                    download_totalsize = 0
+                    download_count = 0
+                    for ap in [ap for ap in ap_to_install if isinstance(ap, AvailablePackage)]:
+                        download_count += 1
+                        if ap.size is not None:
+                            download_totalsize += ap.size
+                    fs_check_free_space(self.download_cache_folder, download_totalsize)
+                    if LeafSettings.DOWNLOAD_STREAM.as_boolean():
+                        # Artifacts may be extracted while they are downloaded, before the extracted size is checked
+                        fs_check_free_space(
+                            self.install_folder, sum(ap.final_size or ap.size or 0 for ap in ap_to_install if isinstance(ap, AvailablePackage))
+                        )
+
+                    # Confirm
+                    text = ", ".join([str(ap.identifier) for ap in ap_to_install])
+                    self.logger.print_quiet("Packages to install: {packages}".format(packages=text))
+                    if download_totalsize > 0:
+                        self.logger.print_default("Total size:", sizeof_fmt(download_totalsize))
+                    self.print_with_confirm(raise_on_decline=True)
+
+                    # Install prereq
+                    prereq_to_install = DependencyUtils.prereq([ap.identifier for ap in ap_to_install], apmap, ipmap, env=env)
+
+                    if len(prereq_to_install) > 0:
+                        try:
+                            self.__install_prereq(prereq_to_install, ipmap, env=env, keep_folder_on_error=keep_folder_on_error)
+                        except BaseException as e:
+                            raise PrereqException(e)
+
+                    # Download ap list
+                    self.logger.print_default("Downloading {size} package(s)".format(size=download_count))
+                    downloaded_la = iter(self.__download_ap_list([mf for mf in ap_to_install if isinstance(mf, AvailablePackage)]))
+                    la_to_install = []
+                    for mf in ap_to_install:
+                        if isinstance(mf, AvailablePackage):
+                            la_to_install.append(next(downloaded_la))
+                        elif isinstance(mf, LeafArtifact):
+                            la_to_install.append(mf)
+
+                    # Check the extracted size, artifacts extracted while downloading are already on disk
+                    extracted_totalsize = 0
+                    for la in la_to_install:
+                        if self.__get_staging_folder(la.identifier).is_dir():
+                            continue
+                        if la.final_size is not None:
+                            extracted_totalsize += la.final_size
+                        else:
+                            extracted_totalsize += la.get_total_size()
+                    fs_check_free_space(self.install_folder, extracted_totalsize)
+
+                    # Extract la list
+                    out = self.__install_la_list(la_to_install, env, ipmap, keep_folder_on_error=keep_folder_on_error)
+
+                return out
+            finally:
+                # Content staged but not installed is not needed anymore
+                self.__clean_staging_folders()
 
     def uninstall_packages(self, pilist: list):
         """
         Remove given package
         """
-        with self.application_lock.acquire():
+        with self.application_lock.acquire(), self.model_cache():
             ipmap = self.list_installed_packages()
 
             iplist_to_remove = DependencyUtils.uninstall(pilist, ipmap, logger=self.logger)
@@ -294,6 +592,7 @@ class PackageManager(RemoteManager):
                     self.__execute_steps(ip.identifier, ipmap, StepExecutor.uninstall)
                     self.logger.print_verbose("Remove folder: {ip.folder}".format(ip=ip))
                     rmtree_force(ip.folder)
+                    self._invalidate_model_cache(self._MODEL_INSTALLED)
                     del ipmap[ip.identifier]
 
                 self.logger.print_default("{count} package(s) removed".format(count=len(iplist_to_remove)))
@@ -302,12 +601,13 @@ class PackageManager(RemoteManager):
         """
         Run the sync steps for all given packages
         """
-        ipmap = self.list_installed_packages()
-        for pi in pilist:
-            self.logger.print_verbose("Sync package {pi}".format(pi=pi))
-            self.__execute_steps(pi, ipmap, StepExecutor.sync, env=env)
+        with self.model_cache():
+            ipmap = self.list_installed_packages()
+            for pi in pilist:
+                self.logger.print_verbose("Sync package {pi}".format(pi=pi))
+                self.__execute_steps(pi, ipmap, StepExecutor.sync, env=env)
 
-    def __execute_steps(self, pi: PackageIdentifier, ipmap: dict, se_func: callable, env: Environment = None):
+    def __execute_steps(self, pi: PackageIdentifier, ipmap: dict, se_func: callable, env: Environment = None, logger: TextLogger = None):
         # Find the package
         ip = find_manifest(pi, ipmap)
         # The environment
@@ -316,13 +616,13 @@ class PackageManager(RemoteManager):
         # build the dependencies
         deps = DependencyUtils.installed([pi], ipmap, env=env, ignore_unknown=True)
         # Update env
-        env.append(self.build_packages_environment(deps))
+        env.append(self.build_packages_environment(deps, ipmap=ipmap))
         # Fix PREREQ_ROOT
         env.set_variable("LEAF_PREREQ_ROOT", self.install_folder)
         # The Variable resolver
         vr = VariableResolver(ip, ipmap.values())
         # Execute steps
-        se = StepExecutor(self.logger, ip, vr, env=env)
+        se = StepExecutor(logger or self.logger, ip, vr, env=env)
         se_func(se)
 
     def build_packages_environment(self, items: list, ipmap=None):
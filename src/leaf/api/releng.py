@@ -17,7 +17,7 @@ from leaf.api import LoggerManager
 from leaf.core.constants import JsonConstants, LeafConstants, LeafFiles, LeafSettings
 from leaf.core.error import LeafException
 from leaf.core.jsonutils import jlayer_update, jloadfile, jtostring, jwritefile
-from leaf.core.utils import hash_compute
+from leaf.core.utils import hash_compute, hash_compute_all
 from leaf.model.modelutils import is_latest_package
 from leaf.model.package import AvailablePackage, ConditionalPackageIdentifier, LeafArtifact, Manifest, PackageIdentifier
 
@@ -61,16 +61,30 @@ class RelengManager(LoggerManager):
     def find_external_info_file(self, artifact: LeafArtifact):
         return artifact.parent / (artifact.name + LeafConstants.EXTINFO_EXTENSION)
 
-    def __build_pkg_node(self, tarfile: Path, manifest: Manifest = None):
+    def __build_pkg_node(self, tarfile: Path, manifest: Manifest = None, hashes: list = None, hash_methods: list = None):
         out = OrderedDict()
         if manifest is None:
             manifest = LeafArtifact(tarfile)
         out[JsonConstants.INFO] = manifest.info_node
-        out[JsonConstants.REMOTE_PACKAGE_HASH] = hash_compute(tarfile)
+        if hashes is None:
+            hashes = hash_compute(tarfile, methods=[None] + (hash_methods or []))
+        hashes = list(OrderedDict.fromkeys(hashes))
+        # The legacy hash is always stored for older clients, additional hashes are stored in a separate list
+        out[JsonConstants.REMOTE_PACKAGE_HASH] = hashes[0]
+        if len(hashes) > 1:
+            out[JsonConstants.REMOTE_PACKAGE_HASHES] = hashes[1:]
         out[JsonConstants.REMOTE_PACKAGE_SIZE] = tarfile.stat().st_size
         return out
 
-    def create_package(self, input_folder: Path, output_file: Path, store_extenal_info: bool = True, tar_extra_args: list = None, validate_only: bool = False):
+    def create_package(
+        self,
+        input_folder: Path,
+        output_file: Path,
+        store_extenal_info: bool = True,
+        tar_extra_args: list = None,
+        validate_only: bool = False,
+        hash_methods: list = None,
+    ):
         """
         Create a leaf artifact from given folder containing a manifest.json
         """
@@ -107,7 +121,7 @@ class RelengManager(LoggerManager):
 
             if store_extenal_info:
                 self.logger.print_default("Write info to {file}".format(file=infofile))
-                jwritefile(infofile, self.__build_pkg_node(output_file, manifest=manifest), pp=True)
+                jwritefile(infofile, self.__build_pkg_node(output_file, manifest=manifest, hash_methods=hash_methods), pp=True)
 
     def generate_index(
         self,
@@ -119,9 +133,11 @@ class RelengManager(LoggerManager):
         use_extra_tags: bool = True,
         prettyprint: bool = False,
         resolve: bool = True,
+        hash_methods: list = None,
     ):
         """
         Create an index.json referencing all given artifacts
+        Artifacts hashes are computed with sha384 and the given additional hash methods
         """
         if not index_file.exists():
             index_file.touch()
@@ -141,6 +157,26 @@ class RelengManager(LoggerManager):
             # Resolve artifacts if needed
             if resolve:
                 artifacts = [a.resolve() for a in artifacts]
+            else:
+                artifacts = list(artifacts)
+
+            # Compute the hashes of the artifacts without info file first, concurrently
+            hashes = OrderedDict()
+            missing_hashes = list(
+                OrderedDict.fromkeys(a for a in artifacts if not use_external_info or not self.find_external_info_file(a).exists())
+            )
+            if len(missing_hashes) > 0:
+
+                def progress(artifact, done, total):
+                    self.logger.print_default("[{done}/{total}] Hash computed for {artifact}".format(done=done, total=total, artifact=artifact))
+
+                self.logger.print_default("Compute the hash of {count} artifact(s)".format(count=len(missing_hashes)))
+                # All hashes of an artifact are computed while reading it once
+                computed = hash_compute_all(
+                    missing_hashes, workers=LeafSettings.BUILD_WORKERS.as_int(), progress=progress, methods=[None] + (hash_methods or [])
+                )
+                hashes = OrderedDict(zip(missing_hashes, computed))
+
             for artifact in artifacts:
                 artifact_node = None
 
@@ -152,7 +188,7 @@ class RelengManager(LoggerManager):
 
                 if artifact_node is None:
                     self.logger.print_default("Compute info for {artifact}".format(artifact=artifact))
-                    artifact_node = self.__build_pkg_node(artifact)
+                    artifact_node = self.__build_pkg_node(artifact, hashes=hashes.get(artifact))
 
                 ap = AvailablePackage(artifact_node)
                 pi = ap.identifier
@@ -274,14 +310,19 @@ class RelengManager(LoggerManager):
         command = [tar, "-c"]
         command += ["-f", output]
         command += ["-C", workdir]
+        # Store the manifest first, so that it can be read without scanning the whole archive
+        # The folder content is listed explicitly, --exclude is not handled the same way by all tar implementations
+        manifest = "./" + LeafFiles.MANIFEST
+        members = [manifest] + sorted("./" + item.name for item in workdir.iterdir() if item.name != LeafFiles.MANIFEST)
 
         if extra_args is not None and len(extra_args) > 0:
             forbidden_args = set(extra_args) & RelengManager.__TAR_FORBIDDEN_ARGS
             if len(forbidden_args) > 0:
                 raise LeafException("You should not use tar extra arguments: {invalid_args}".format(invalid_args=" ".join(forbidden_args)))
-            command += extra_args
+            for arg in extra_args:
+                command += members if arg == "." else [arg]
         else:
-            command.append(".")
+            command += members
 
         command_text = " ".join(map(str, command))
         self.logger.print_default("Executing command: {cmd}".format(cmd=command_text))
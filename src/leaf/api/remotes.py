@@ -7,18 +7,25 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
+import marshal
 import re
+import sys
+import time
 from builtins import Exception
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from threading import Lock
 
 import gnupg
 
 from leaf.api.base import LoggerManager
 from leaf.core.constants import JsonConstants, LeafConstants, LeafFiles, LeafSettings
-from leaf.core.download import PRIORITIES_RANGE, download_file
+from leaf.core.download import PRIORITIES_RANGE, download_file, download_file_if_modified
 from leaf.core.error import LeafException, NoEnabledRemoteException, NoRemoteException, RemoteFetchException
-from leaf.core.jsonutils import jloadfile
+from leaf.core.jsonutils import jloadfile, jwritefile
+from leaf.core.logger import print_trace
+from leaf.core.utils import fs_atomic_write, fs_get_identity, fs_is_racy
 from leaf.model.modelutils import check_leaf_min_version
 from leaf.model.remote import Remote
 
@@ -65,9 +72,15 @@ class GPGManager(LoggerManager):
 class RemoteManager(GPGManager):
 
     __REMOTE_ALIAS_PATTERN = re.compile(r"[\S]+")
+    # Fixed marshal format, the compiled index only holds plain data
+    __COMPILED_VERSION = 4
+    # Plain dicts only keep the order of the index keys since Python 3.7
+    __COMPILED_SUPPORTED = sys.version_info >= (3, 7)
+    __COMPILED_SCALARS = (str, int, float, bool, type(None))
 
     def __init__(self):
         GPGManager.__init__(self)
+        self.__stats_lock = Lock()
 
     @property
     def remote_cache_folder(self):
@@ -76,7 +89,8 @@ class RemoteManager(GPGManager):
         return out
 
     def __clean_remote_files(self, alias: str):
-        for f in self.__get_remote_files(alias):
+        self._invalidate_model_cache(self._MODEL_AVAILABLE)
+        for f in self.__get_remote_files(alias) + (self.__get_remote_compiled_file(alias),):
             if f.exists():
                 f.unlink()
 
@@ -84,8 +98,165 @@ class RemoteManager(GPGManager):
         return (
             self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=".json"),
             self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=LeafConstants.GPG_SIG_EXTENSION),
+            self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=LeafConstants.VALIDATORS_EXTENSION),
         )
 
+    def __get_remote_compiled_file(self, alias: str):
+        return self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=LeafConstants.COMPILED_EXTENSION)
+
+    def __read_remote_content(self, alias: str, unchanged: bool = False):
+        """
+        Return the content of the cached index of the remote.
+        The index is parsed once, then its content is read from a compiled file as long as the index file is unchanged.
+        If unchanged is set, the index content is known to be the same even if the file has been touched
+        """
+        rindex = self.__get_remote_files(alias)[0]
+        if not RemoteManager.__COMPILED_SUPPORTED:
+            return jloadfile(rindex)
+        rcompiled = self.__get_remote_compiled_file(alias)
+        identity = fs_get_identity(rindex)
+        if rcompiled.exists():
+            try:
+                with rcompiled.open("rb") as fp:
+                    compiled = marshal.load(fp)
+                # The file is only trusted if it holds plain data, marshal can also load code objects
+                if not RemoteManager.__is_compiled_valid(compiled):
+                    raise ValueError("Unexpected content")
+                compiled_identity, content = compiled
+                if compiled_identity is not None and compiled_identity == identity:
+                    return content
+                if unchanged:
+                    self.__write_remote_compiled_file(alias, identity, content)
+                    return content
+            except Exception:
+                print_trace("Invalid compiled index for remote {alias}".format(alias=alias))
+        content = jloadfile(rindex)
+        self.__write_remote_compiled_file(alias, identity, content)
+        return content
+
+    @staticmethod
+    def __is_compiled_valid(compiled) -> bool:
+        """
+        Check that the compiled index only holds plain data: [identity, content]
+        """
+        if type(compiled) is not list or len(compiled) != 2 or type(compiled[1]) is not dict:
+            return False
+        if compiled[0] is not None and (type(compiled[0]) is not list or any(type(i) is not int for i in compiled[0])):
+            return False
+        # Iterative walk, an index can have thousands of nodes
+        stack = [compiled[1]]
+        while len(stack) > 0:
+            item = stack.pop()
+            if type(item) is dict:
+                if any(type(k) is not str for k in item):
+                    return False
+                values = item.values()
+            else:
+                values = item
+            for value in values:
+                if type(value) in (dict, list):
+                    stack.append(value)
+                elif type(value) not in RemoteManager.__COMPILED_SCALARS:
+                    return False
+        return True
+
+    def __write_remote_compiled_file(self, alias: str, identity: list, content: dict):
+        """
+        Write the compiled index, it is only an optimization: errors are ignored
+        """
+
+        def to_builtins(item):
+            # marshal only handles builtin types, keys order is kept by plain dicts
+            if isinstance(item, dict):
+                return {k: to_builtins(v) for k, v in item.items()}
+            if isinstance(item, list):
+                return [to_builtins(v) for v in item]
+            return item
+
+        if fs_is_racy(identity):
+            # The index may still change without changing its identity, the compiled file will be written again
+            identity = None
+        try:
+            # Remotes may be fetched concurrently by several processes
+            with fs_atomic_write(self.__get_remote_compiled_file(alias), mode="wb") as fp:
+                marshal.dump([identity, to_builtins(content)], fp, RemoteManager.__COMPILED_VERSION)
+        except Exception:
+            print_trace("Cannot write the compiled index for remote {alias}".format(alias=alias))
+
+    def __read_remote_validators(self, remote: Remote):
+        """
+        Return the http validators of the cached index if the cache is complete
+        """
+        rindex, rsig, rvalidators = self.__get_remote_files(remote.alias)
+        if rindex.exists() and rvalidators.exists() and (remote.gpg_key is None or rsig.exists()):
+            try:
+                return jloadfile(rvalidators)
+            except Exception:
+                print_trace("Invalid validators file for remote {remote.alias}".format(remote=remote))
+        return None
+
+    @property
+    def remote_stats_file(self):
+        return self.cache_folder / LeafFiles.CACHE_REMOTES_STATS_FILENAME
+
+    def __read_remote_stats(self) -> dict:
+        if self.remote_stats_file.exists():
+            try:
+                return jloadfile(self.remote_stats_file)
+            except Exception:
+                print_trace("Invalid remote statistics file")
+        return {}
+
+    def read_remote_stats(self) -> dict:
+        """
+        Return the download statistics observed for each remote, by alias
+        """
+        with self.__stats_lock:
+            return self.__read_remote_stats()
+
+    def update_remote_stats(self, remote: Remote, size: int = None, elapsed: float = None, latency: float = None, failed: bool = False):
+        """
+        Record the outcome of a download from the given remote.
+        Throughput (bytes/s) and latency (s) are averaged with the previous observations
+        """
+
+        def smooth(previous, value):
+            return value if previous is None else (previous + value) / 2
+
+        with self.__stats_lock:
+            allstats = self.__read_remote_stats()
+            stats = allstats.setdefault(remote.alias, {})
+            if failed:
+                stats[JsonConstants.REMOTE_STATS_FAILURE] = time.time()
+            else:
+                stats.pop(JsonConstants.REMOTE_STATS_FAILURE, None)
+                if latency is not None:
+                    stats[JsonConstants.REMOTE_STATS_LATENCY] = smooth(stats.get(JsonConstants.REMOTE_STATS_LATENCY), latency)
+                if size and elapsed:
+                    throughput = size / max(elapsed - (latency or 0), 0.001)
+                    stats[JsonConstants.REMOTE_STATS_THROUGHPUT] = smooth(stats.get(JsonConstants.REMOTE_STATS_THROUGHPUT), throughput)
+            # Other leaf processes may read the statistics while they are written
+            jwritefile(self.remote_stats_file, allstats, atomic=True)
+
+    def sort_candidates(self, candidates: list, size: int = None) -> list:
+        """
+        Sort the candidates of an available package: remotes which failed recently come last,
+        then remotes are sorted by priority, and remotes with the same priority by expected download time.
+        Remotes without statistics are tried first so that they get measured
+        """
+        allstats = self.read_remote_stats()
+        now = time.time()
+
+        def key(ap):
+            stats = allstats.get(ap.remote.alias, {})
+            failed = now - stats.get(JsonConstants.REMOTE_STATS_FAILURE, 0) < LeafConstants.REMOTE_FAILURE_DELAY
+            expected_time = stats.get(JsonConstants.REMOTE_STATS_LATENCY, 0)
+            if size and JsonConstants.REMOTE_STATS_THROUGHPUT in stats:
+                expected_time += size / stats[JsonConstants.REMOTE_STATS_THROUGHPUT]
+            return failed, ap.remote.priority, expected_time
+
+        return sorted(candidates, key=key)
+
     def list_remotes(self, only_enabled: bool = False):
         out = OrderedDict()
         remotes = self.read_user_configuration().remotes
@@ -97,10 +268,10 @@ class RemoteManager(GPGManager):
                 out[alias] = remote
                 if remote.enabled:
                     # Load content if remote is enabled cache exists and check signature is present if needed
-                    rindex, rsig = self.__get_remote_files(alias)
+                    rindex, rsig, _validators = self.__get_remote_files(alias)
                     if rindex.exists() and (remote.gpg_key is None or rsig.exists()):
                         try:
-                            remote.content = jloadfile(rindex)
+                            remote.content = self.__read_remote_content(alias)
                         except Exception:
                             self.logger.print_default("Invalid json file cache for remote {alias}".format(alias=alias))
                             self.__clean_remote_files(alias)
@@ -163,24 +334,48 @@ class RemoteManager(GPGManager):
             del remotes[alias]
         self.__clean_remote_files(alias)
 
-    def __fetch_remote(self, remote: Remote):
-        # clean files if they exist
-        self.__clean_remote_files(remote.alias)
+    def __download_remote_files(self, remote: Remote, validators: dict = None):
+        """
+        Download the index and its signature if needed, this method is called from download workers
+        @return: a tuple (modified, validators), see download_file_if_modified
+        """
+        index, sig, _validators = self.__get_remote_files(remote.alias)
+        modified, validators = download_file_if_modified(remote.url, index, validators=validators)
+        if modified and remote.gpg_key is not None:
+            download_file(remote.url + LeafConstants.GPG_SIG_EXTENSION, sig)
+        return modified, validators
+
+    def __fetch_remote(self, remote: Remote, download: Future):
+        """
+        Verify and load the remote content once its files are downloaded
+        """
         # Target files
-        index, sig = self.__get_remote_files(remote.alias)
+        index, sig, rvalidators = self.__get_remote_files(remote.alias)
         try:
-            # Download index
-            self.logger.print_default("Fetching remote {remote.alias}".format(remote=remote))
-            download_file(remote.url, index)
+            modified, validators = download.result()
+            if not modified:
+                # Index has not changed, no need to verify it again
+                self.logger.print_verbose("Remote {remote.alias} is up to date".format(remote=remote))
+                # The index file has been touched, keep its compiled content
+                self.__read_remote_content(remote.alias, unchanged=True)
+                return
+            # Validators will be written once the new index is verified
+            if rvalidators.exists():
+                rvalidators.unlink()
+            # The new index is compiled once verified
+            rcompiled = self.__get_remote_compiled_file(remote.alias)
+            if rcompiled.exists():
+                rcompiled.unlink()
             # If gpg enabled
             gpgkey = remote.gpg_key
             if gpgkey is not None:
-                download_file(remote.url + LeafConstants.GPG_SIG_EXTENSION, sig)
                 self.logger.print_default("Verifying signature for remote {0.alias}".format(remote))
                 self.gpg_import_keys(gpgkey)
                 self.gpg_verify_file(index, sig, expected_key=gpgkey)
-            remote.content = jloadfile(index)
+            remote.content = self.__read_remote_content(remote.alias)
             self.__check_remote_content(remote)
+            if validators:
+                jwritefile(rvalidators, validators)
         except Exception as e:
             self.__clean_remote_files(remote.alias)
             self.print_exception(RemoteFetchException(remote, e))
@@ -188,19 +383,36 @@ class RemoteManager(GPGManager):
     def fetch_remotes(self, force_refresh: bool = False):
         """
         Refresh remotes content with smart refresh, ie auto refresh after X days
+        Remote files are downloaded concurrently, then verified in the remotes order
         """
         remotes = self.list_remotes(only_enabled=True)
         if len(remotes) == 0:
             raise NoRemoteException()
+        remotes_to_fetch = []
         for alias, remote in remotes.items():
-            rindex, _sig = self.__get_remote_files(alias)
+            rindex, _sig, _validators = self.__get_remote_files(alias)
             if not force_refresh and rindex.exists():
                 if self.is_file_outdated(rindex):
                     self.logger.print_verbose("Cache for remote {0} is outdated".format(alias))
                 else:
                     # Smart refresh skip refresh for current remote
                     continue
-            self.__fetch_remote(remote)
+            remotes_to_fetch.append(remote)
+
+        if len(remotes_to_fetch) > 0:
+            workers = max(1, min(LeafSettings.DOWNLOAD_WORKERS.as_int(), len(remotes_to_fetch)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                downloads = []
+                for remote in remotes_to_fetch:
+                    # Use conditional download if the cache is complete, else clean files if they exist
+                    validators = self.__read_remote_validators(remote)
+                    if validators is None:
+                        self.__clean_remote_files(remote.alias)
+                    self.logger.print_default("Fetching remote {remote.alias}".format(remote=remote))
+                    downloads.append((remote, executor.submit(self.__download_remote_files, remote, validators=validators)))
+                for remote, download in downloads:
+                    self.__fetch_remote(remote, download)
+            self._invalidate_model_cache(self._MODEL_AVAILABLE)
 
     def __check_remote_content(self, remote: Remote):
         # Check leaf min version for all packages
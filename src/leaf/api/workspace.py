@@ -250,58 +250,62 @@ class WorkspaceManager(PackageManager):
             self.ws_config_file.touch(exist_ok=True)
 
     def provision_profile(self, profile):
-        if not profile.folder.is_dir():
-            # Create folder if needed
-            profile.folder.mkdir(parents=True)
-        else:
-            # Clean folder content
-            for item in profile.folder.glob("*"):
-                if item.is_symlink():
-                    item.unlink()
-                else:
-                    shutil.rmtree(str(item))
-
-        # Check if all needed packages are installed
-        missing_packages = DependencyUtils.install(
-            profile.packages, self.list_available_packages(), self.list_installed_packages(), env=self.build_pf_environment(profile)
-        )
-        if len(missing_packages) == 0:
-            self.logger.print_verbose("All packages are already installed")
-        else:
-            self.logger.print_default("Profile is out of sync")
-            try:
-                self.install_packages(profile.packages, env=self.build_pf_environment(profile))
-            except Exception as e:
-                raise ProfileProvisioningException(e)
-
-        # Do all needed links
-        errors = 0
-        for ip in self.get_profile_dependencies(profile):
-            pi_folder = profile.folder / ip.identifier.name
-            if pi_folder.exists():
-                pi_folder = profile.folder / str(ip.identifier)
-            try:
-                env = self.build_pf_environment(profile)
-                self.sync_packages([ip.identifier], env=env)
-                pi_folder.symlink_to(ip.folder)
-            except Exception as e:
-                errors += 1
-                self.logger.print_error("Error while sync operation on {ip.identifier}".format(ip=ip))
-                self.logger.print_error(str(e))
-                print_trace()
-
-        # Touch folder when provisionning is done without error
-        if errors == 0:
-            profile.folder.touch(exist_ok=True)
+        with self.model_cache():
+            if not profile.folder.is_dir():
+                # Create folder if needed
+                profile.folder.mkdir(parents=True)
+            else:
+                # Clean folder content
+                for item in profile.folder.glob("*"):
+                    if item.is_symlink():
+                        item.unlink()
+                    else:
+                        shutil.rmtree(str(item))
+
+            # Check if all needed packages are installed
+            missing_packages = DependencyUtils.install(
+                profile.packages, self.list_available_packages(), self.list_installed_packages(), env=self.build_pf_environment(profile)
+            )
+            if len(missing_packages) == 0:
+                self.logger.print_verbose("All packages are already installed")
+            else:
+                self.logger.print_default("Profile is out of sync")
+                try:
+                    self.install_packages(profile.packages, env=self.build_pf_environment(profile))
+                except Exception as e:
+                    raise ProfileProvisioningException(e)
+
+            # Do all needed links
+            errors = 0
+            for ip in self.get_profile_dependencies(profile):
+                pi_folder = profile.folder / ip.identifier.name
+                if pi_folder.exists():
+                    pi_folder = profile.folder / str(ip.identifier)
+                try:
+                    env = self.build_pf_environment(profile)
+                    self.sync_packages([ip.identifier], env=env)
+                    pi_folder.symlink_to(ip.folder)
+                except Exception as e:
+                    errors += 1
+                    self.logger.print_error("Error while sync operation on {ip.identifier}".format(ip=ip))
+                    self.logger.print_error(str(e))
+                    print_trace()
+            # Packages linked in the profile folder have changed
+            self._invalidate_model_cache(self._MODEL_INSTALLED)
+
+            # Touch folder when provisionning is done without error
+            if errors == 0:
+                profile.folder.touch(exist_ok=True)
 
     def build_full_environment(self, profile: Profile):
-        self.is_profile_sync(profile, raise_if_not_sync=True)
-        out = self.build_pf_environment(profile)
-        ipmap = self.list_installed_packages()
-        if not LeafSettings.PROFILE_NORELATIVE.as_boolean():
-            ipmap.update(self.list_installed_packages(alt_user_root_folder=profile.folder))
-        out.append(self.build_packages_environment(self.get_profile_dependencies(profile, ipmap=ipmap), ipmap=ipmap))
-        return out
+        with self.model_cache():
+            self.is_profile_sync(profile, raise_if_not_sync=True)
+            out = self.build_pf_environment(profile)
+            ipmap = self.list_installed_packages()
+            if not LeafSettings.PROFILE_NORELATIVE.as_boolean():
+                ipmap.update(self.list_installed_packages(alt_user_root_folder=profile.folder))
+            out.append(self.build_packages_environment(self.get_profile_dependencies(profile, ipmap=ipmap), ipmap=ipmap))
+            return out
 
     def build_pf_environment(self, profile: Profile):
         return Environment.build(self.build_builtin_environment(), self.build_user_environment(), self.build_ws_environment(), profile.build_environment())
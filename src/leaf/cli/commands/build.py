@@ -16,6 +16,7 @@ from leaf.cli.base import LeafCommand
 from leaf.cli.cliutils import string_to_bool
 from leaf.core.constants import JsonConstants, LeafFiles
 from leaf.core.error import LeafException
+from leaf.core.utils import hash_methods
 
 
 class BuildPackSubCommand(LeafCommand):
@@ -48,6 +49,14 @@ class BuildPackSubCommand(LeafCommand):
         parser.add_argument("-i", "--input", metavar="FOLDER", type=Path, dest="input_folder", help="package folder")
         parser.add_argument("--no-info", action="store_false", dest="syore_external_info", help="do not store artifact info in a separate file")
         parser.add_argument("--validate-only", action="store_true", dest="validate_only", help="only validate manifest.json model, do not create the package")
+        parser.add_argument(
+            "--hash",
+            action="append",
+            choices=hash_methods(),
+            dest="hash_methods",
+            metavar="METHOD",
+            help="also store the artifact hash computed with the given method, like blake2b (the sha384 hash is always stored)",
+        )
         parser.add_argument("tar_extra_args", metavar="TAR_ARGS", nargs="*", help="extra arguments given to tar command line\n(must start with '--')")
 
     def execute(self, args, uargs):
@@ -65,7 +74,12 @@ class BuildPackSubCommand(LeafCommand):
             raise ValueError("Invalid input folder")
 
         rm.create_package(
-            pkg_folder, args.output_file, store_extenal_info=args.syore_external_info, tar_extra_args=args.tar_extra_args, validate_only=args.validate_only
+            pkg_folder,
+            args.output_file,
+            store_extenal_info=args.syore_external_info,
+            tar_extra_args=args.tar_extra_args,
+            validate_only=args.validate_only,
+            hash_methods=args.hash_methods,
         )
 
 
@@ -84,6 +98,14 @@ class BuildIndexSubCommand(LeafCommand):
         )
         parser.add_argument("--no-extra-tags", action="store_false", dest="use_extra_tags", help='do not use extra tags in "*.tags" files')
         parser.add_argument("--prettyprint", action="store_true", dest="prettyprint", help="pretty print json")
+        parser.add_argument(
+            "--hash",
+            action="append",
+            choices=hash_methods(),
+            dest="hash_methods",
+            metavar="METHOD",
+            help="also store the artifact hash computed with the given method, like blake2b (the sha384 hash is always stored)",
+        )
         parser.add_argument(
             "--resolve", action="store_true", dest="resolve", help="Resolves artifacts path to ensure they are relative to index (NB: symlinks are resolved)"
         )
@@ -108,6 +130,7 @@ class BuildIndexSubCommand(LeafCommand):
             use_extra_tags=args.use_extra_tags,
             prettyprint=args.prettyprint,
             resolve=args.resolve,
+            hash_methods=args.hash_methods,
         )
 
 
@@ -0,0 +1,65 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+from leaf.api import PackageManager
+from leaf.cli.base import LeafCommand
+from leaf.core.constants import LeafConstants
+from leaf.rendering.formatutils import sizeof_fmt
+
+
+class CacheStatsCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "stats", "display the leaf download cache usage")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        cache = pm.download_cache
+        pm.logger.print_default("Cache folder: {folder}".format(folder=cache.folder))
+        pm.logger.print_default("Cached files: {count}".format(count=len(cache.list_files())))
+        pm.logger.print_default("Total size:   {size}".format(size=sizeof_fmt(cache.get_total_size())))
+
+
+class CacheVerifyCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "verify", "check the cached artifacts and rebuild the cache ledger")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        with pm.application_lock.acquire():
+            removed = pm.download_cache.verify()
+        for file in removed:
+            pm.logger.print_default("Remove corrupted file {file}".format(file=file))
+        pm.logger.print_default("{count} corrupted file(s) removed from the leaf cache folder".format(count=len(removed)))
+
+
+class CachePruneCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "prune", "remove the least recently used artifacts from the leaf download cache")
+
+    def _configure_parser(self, parser):
+        super()._configure_parser(parser)
+        parser.add_argument(
+            "--max-size",
+            dest="max_size",
+            metavar="MB",
+            type=int,
+            default=LeafConstants.CACHE_SIZE_TARGET // (1024 * 1024),
+            help="the size of the cache after pruning, in MB (default: %(default)s)",
+        )
+        parser.add_argument("--all", dest="prune_all", action="store_true", help="remove all cached artifacts")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        with pm.application_lock.acquire():
+            if args.prune_all:
+                pm.download_cache.clean()
+                pm.logger.print_default("Leaf cache folder cleaned")
+            else:
+                removed = pm.download_cache.evict(args.max_size * 1024 * 1024) + pm.download_cache.prune_partial_files()
+                pm.logger.print_default("{count} file(s) removed from the leaf cache folder".format(count=len(removed)))
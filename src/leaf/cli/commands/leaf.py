@@ -12,6 +12,7 @@ from argparse import ArgumentParser, RawDescriptionHelpFormatter, SUPPRESS
 from leaf import __help_description__, __version__
 from leaf.cli.cliutils import EnvSetterAction
 from leaf.cli.commands.build import BuildIndexSubCommand, BuildManifestSubCommand, BuildPackSubCommand
+from leaf.cli.commands.cache import CachePruneCommand, CacheStatsCommand, CacheVerifyCommand
 from leaf.cli.commands.config import ConfigListCommand, ConfigMetaCommand, SettingGetCommand, SettingResetCommand, SettingSetCommand
 from leaf.cli.commands.env import EnvBuiltinCommand, EnvPackageCommand, EnvPrintCommand, EnvProfileCommand, EnvUserCommand, EnvWorkspaceCommand
 from leaf.cli.commands.help import HelpCommand
@@ -114,6 +115,14 @@ class LeafRootCommand(LeafMetaCommand):
                     accept_default=True,
                     plugins_manager=plugins_manager,
                 ),
+                # Download cache
+                LeafMetaCommand(
+                    "cache",
+                    "manage the leaf download cache",
+                    [CacheStatsCommand(), CacheVerifyCommand(), CachePruneCommand()],
+                    accept_default=True,
+                    plugins_manager=plugins_manager,
+                ),
                 # Releng
                 LeafMetaCommand(
                     "build",
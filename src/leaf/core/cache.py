@@ -0,0 +1,341 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+from leaf.core.constants import LeafConstants
+from leaf.core.error import LeafException, LockException
+from leaf.core.jsonutils import jloadfile, jwritefile
+from leaf.core.lock import LockFile
+from leaf.core.logger import print_trace
+from leaf.core.utils import fs_get_identity, fs_is_racy, get_cached_artifact_name, hash_check, hash_parse, rmtree_force
+
+
+class ArtifactCache:
+
+    """
+    Content-addressed store for downloaded artifacts.
+    Artifacts are stored by their hash, {folder}/{method}/{xx}/{digest}.
+    Every cached file has a ledger entry next to it, {file}.ledger, which keeps its size and its last access time,
+    so that the least recently used artifacts can be evicted first.
+    The entry also records the identity of a verified file, (inode, size, mtime), so that an unchanged and not too recent
+    artifact does not need to be hashed again.
+    The total size of the cache is kept in the ledger file, so that it is known without scanning the folder.
+    The cache can be shared by several leaf processes: the ledger and every artifact are protected
+    by lock files
+    """
+
+    __LEDGER_VERSION = "version"
+    __LEDGER_TOTAL_SIZE = "totalSize"
+    __LEDGER_SIZE = "size"
+    __LEDGER_ACCESS = "access"
+    __LEDGER_IDENTITY = "identity"
+    __LEDGER_HASH = "hash"
+    # Version of the ledger format, a ledger with another version is rebuilt
+    __VERSION = 2
+    __HASHED_FILE_PATTERN = re.compile(r"^(\w+)/[0-9a-f]{2}/([0-9a-f]+)$")
+
+    def __init__(self, folder: Path, ledger_file: Path, locks_folder: Path):
+        self.__folder = folder
+        self.__ledger_file = ledger_file
+        self.__locks_folder = locks_folder
+        self.__thread_lock = Lock()
+
+    @property
+    def folder(self) -> Path:
+        return self.__folder
+
+    def get_file(self, filename: str, hashstr: str = None) -> Path:
+        """
+        Return the path of the given artifact in the cache.
+        Artifacts without hash cannot be addressed by their content, they get a unique name
+        """
+        if hashstr is None:
+            return self.__folder / get_cached_artifact_name(filename, None)
+        method, digest = hash_parse(hashstr)
+        return self.__folder / method / digest[:2] / digest
+
+    def __get_lockfile(self, name: str) -> LockFile:
+        self.__locks_folder.mkdir(parents=True, exist_ok=True)
+        return LockFile(self.__locks_folder / (name + ".lock"))
+
+    def __get_artifact_lockfile(self, file: Path) -> LockFile:
+        return self.__get_lockfile(file.relative_to(self.__folder).as_posix().replace("/", "_"))
+
+    @contextmanager
+    def __lock(self):
+        # Lock files only protect against other processes, threads also need a lock
+        with self.__thread_lock, self.__get_lockfile("ledger").acquire(blocking=True):
+            yield
+
+    @contextmanager
+    def lock(self, file: Path, on_wait: callable = None):
+        """
+        Lock the given cached file, to be used while the file is downloaded.
+        If another process holds the lock, on_wait is called and this process waits for the lock
+        """
+        lockfile = self.__get_artifact_lockfile(file)
+        lock = lockfile.acquire()
+        try:
+            lock.__enter__()
+        except LockException:
+            if on_wait is not None:
+                on_wait()
+            lock = lockfile.acquire(blocking=True)
+            lock.__enter__()
+        try:
+            yield
+        finally:
+            lock.__exit__(None, None, None)
+
+    @staticmethod
+    def __get_entry_file(file: Path) -> Path:
+        return file.parent / (file.name + LeafConstants.LEDGER_EXTENSION)
+
+    def __read_entry(self, file: Path) -> dict:
+        entry_file = ArtifactCache.__get_entry_file(file)
+        if entry_file.exists():
+            try:
+                return jloadfile(entry_file)
+            except Exception:
+                print_trace("Invalid cache ledger entry {file}".format(file=entry_file))
+        return None
+
+    def __write_entry(self, file: Path, entry: dict):
+        jwritefile(ArtifactCache.__get_entry_file(file), entry, atomic=True)
+
+    def __delete(self, file: Path) -> bool:
+        """
+        Remove the cached file, its ledger entry and its lock file, unless the file is locked by a download
+        @return: True if the file has been removed
+        """
+        lockfile = self.__get_artifact_lockfile(file)
+        try:
+            with lockfile.acquire():
+                for f in (file, ArtifactCache.__get_entry_file(file)):
+                    if f.exists():
+                        f.unlink()
+                # Processes waiting for the removed lock file lock a new one
+                if lockfile.file.exists():
+                    lockfile.file.unlink()
+            return True
+        except LockException:
+            return False
+
+    def __load_entries(self) -> dict:
+        """
+        Read the ledger entries of all cached files, missing entries are created from the files
+        """
+        out = OrderedDict()
+        if self.__folder.is_dir():
+            for root, _dirs, names in os.walk(str(self.__folder)):
+                for name in names:
+                    file = Path(root) / name
+                    if name.endswith(LeafConstants.LEDGER_EXTENSION):
+                        if not (file.parent / name[: -len(LeafConstants.LEDGER_EXTENSION)]).exists():
+                            # The cached file has been removed
+                            file.unlink()
+                        continue
+                    if name.endswith((LeafConstants.PARTIAL_EXTENSION, LeafConstants.JOURNAL_EXTENSION, ".tmp")):
+                        # Download in progress or interrupted
+                        continue
+                    entry = self.__read_entry(file)
+                    stat = file.stat()
+                    if entry is None or entry.get(ArtifactCache.__LEDGER_SIZE) != stat.st_size:
+                        # For example, a cache created by a previous version
+                        entry = {ArtifactCache.__LEDGER_SIZE: stat.st_size, ArtifactCache.__LEDGER_ACCESS: stat.st_atime}
+                        self.__write_entry(file, entry)
+                    out[file.relative_to(self.__folder).as_posix()] = entry
+        return out
+
+    def __read_total_size(self) -> int:
+        """
+        Return the total size from the ledger file, the ledger is rebuilt if it is missing or invalid
+        """
+        if self.__ledger_file.exists() and self.__folder.is_dir():
+            try:
+                ledger = jloadfile(self.__ledger_file)
+                if ledger.get(ArtifactCache.__LEDGER_VERSION) == ArtifactCache.__VERSION:
+                    return ledger[ArtifactCache.__LEDGER_TOTAL_SIZE]
+            except Exception:
+                print_trace("Invalid cache ledger {file}, scan the cache folder".format(file=self.__ledger_file))
+        # The scan result is saved, the folder is not scanned again
+        total_size = sum(e[ArtifactCache.__LEDGER_SIZE] for e in self.__load_entries().values())
+        self.__write_total_size(total_size)
+        return total_size
+
+    def __write_total_size(self, total_size: int):
+        self.__ledger_file.parent.mkdir(parents=True, exist_ok=True)
+        jwritefile(self.__ledger_file, {ArtifactCache.__LEDGER_VERSION: ArtifactCache.__VERSION, ArtifactCache.__LEDGER_TOTAL_SIZE: total_size}, atomic=True)
+
+    @staticmethod
+    def __set_verified(entry: dict, file: Path, hashstr: str):
+        identity = fs_get_identity(file)
+        if not fs_is_racy(identity):
+            # A file modified too recently is hashed again next time
+            entry[ArtifactCache.__LEDGER_IDENTITY] = identity
+            entry[ArtifactCache.__LEDGER_HASH] = hashstr
+
+    def touch(self, file: Path, hashstr: str = None):
+        """
+        Record a new file or an access to a cached file.
+        The access time is only recorded in the ledger: the cached file may be a hard link to the artifact
+        of a local remote, owned by another user, and its times must not be changed.
+        If a hash is given, the file has just been verified with it
+        """
+        if file.exists():
+            with self.__lock():
+                total_size = self.__read_total_size()
+                entry = {ArtifactCache.__LEDGER_SIZE: file.stat().st_size, ArtifactCache.__LEDGER_ACCESS: time.time()}
+                previous = self.__read_entry(file)
+                if previous is not None:
+                    total_size -= previous[ArtifactCache.__LEDGER_SIZE]
+                    if hashstr is None and ArtifactCache.__LEDGER_HASH in previous:
+                        # Keep the previous verification, it is only trusted if the file identity is unchanged
+                        entry[ArtifactCache.__LEDGER_IDENTITY] = previous[ArtifactCache.__LEDGER_IDENTITY]
+                        entry[ArtifactCache.__LEDGER_HASH] = previous[ArtifactCache.__LEDGER_HASH]
+                if hashstr is not None:
+                    ArtifactCache.__set_verified(entry, file, hashstr)
+                self.__write_entry(file, entry)
+                self.__write_total_size(total_size + entry[ArtifactCache.__LEDGER_SIZE])
+
+    def is_verified(self, file: Path, hashstr: str) -> bool:
+        """
+        Check if the file has already been verified with the given hash, and has not changed since
+        """
+        if hashstr is None or not file.exists():
+            return False
+        # Entries are replaced atomically, they can be read without lock
+        entry = self.__read_entry(file)
+        return (
+            entry is not None
+            and entry.get(ArtifactCache.__LEDGER_HASH) == hashstr
+            and entry.get(ArtifactCache.__LEDGER_IDENTITY) == fs_get_identity(file)
+        )
+
+    def list_files(self) -> list:
+        """
+        Return all cached files, the least recently used first
+        """
+        with self.__lock():
+            files = self.__load_entries()
+        return [self.__folder / key for key, _ in sorted(files.items(), key=lambda item: item[1][ArtifactCache.__LEDGER_ACCESS])]
+
+    def get_total_size(self) -> int:
+        with self.__lock():
+            return self.__read_total_size()
+
+    def evict(self, max_size: int) -> list:
+        """
+        Remove the least recently used files until the cache size is below the given size
+        Files locked by a download are kept, their lock file is removed with the others
+        @return: the list of removed files
+        """
+        out = []
+        with self.__lock():
+            total_size = self.__read_total_size()
+            if total_size <= max_size:
+                return out
+            files = self.__load_entries()
+            for key, entry in sorted(files.items(), key=lambda item: item[1][ArtifactCache.__LEDGER_ACCESS]):
+                if total_size <= max_size:
+                    break
+                file = self.__folder / key
+                if self.__delete(file):
+                    total_size -= entry[ArtifactCache.__LEDGER_SIZE]
+                    out.append(file)
+            self.__write_total_size(total_size)
+        return out
+
+    def verify(self) -> list:
+        """
+        Rebuild the ledger from the cached files, and check the hash of all artifacts.
+        Corrupted artifacts are removed, unless a download holds their lock
+        @return: the list of removed files
+        """
+        out = []
+        with self.__lock():
+            total_size = 0
+            for key, entry in self.__load_entries().items():
+                file = self.__folder / key
+                hashstr = self.__check_file(key, file)
+                if hashstr is False:
+                    if self.__delete(file):
+                        out.append(file)
+                        continue
+                elif hashstr is not None:
+                    ArtifactCache.__set_verified(entry, file, hashstr)
+                    self.__write_entry(file, entry)
+                total_size += entry[ArtifactCache.__LEDGER_SIZE]
+            self.__write_total_size(total_size)
+        return out
+
+    @staticmethod
+    def __check_file(key: str, file: Path):
+        """
+        @return: the verified hash, None if the file cannot be verified, False if the file is corrupted
+        """
+        match = ArtifactCache.__HASHED_FILE_PATTERN.match(key)
+        if match is None:
+            # Not addressed by its content, cannot be verified
+            return None
+        hashstr = "{0}:{1}".format(*match.groups())
+        try:
+            return hashstr if hash_check(file, hashstr) else False
+        except LeafException:
+            # Unsupported hash
+            return None
+
+    def prune_partial_files(self, max_age: float = LeafConstants.CACHE_PARTIAL_MAX_AGE) -> list:
+        """
+        Remove the files of interrupted downloads (partial files and their journal) not modified since max_age seconds.
+        Files of downloads in progress are kept, their artifact is locked
+        @return: the list of removed files
+        """
+        out = []
+        if not self.__folder.is_dir():
+            return out
+        limit = time.time() - max_age
+        for root, _dirs, names in os.walk(str(self.__folder)):
+            for name in names:
+                for ext in (LeafConstants.PARTIAL_EXTENSION, LeafConstants.JOURNAL_EXTENSION):
+                    if name.endswith(ext):
+                        file = Path(root) / name
+                        try:
+                            if file.stat().st_mtime >= limit:
+                                continue
+                            artifact = file.parent / name[: -len(ext)]
+                            lockfile = self.__get_artifact_lockfile(artifact)
+                            with lockfile.acquire():
+                                file.unlink()
+                                # The lock is not needed anymore if nothing is left for the artifact
+                                if not any((artifact.parent / (artifact.name + e)).exists() for e in ("", LeafConstants.PARTIAL_EXTENSION, LeafConstants.JOURNAL_EXTENSION)):
+                                    lockfile.file.unlink()
+                            out.append(file)
+                        except (LockException, FileNotFoundError):
+                            # Download in progress, or file removed by another process
+                            pass
+        return out
+
+    def clean(self):
+        """
+        Remove all cached files
+        """
+        with self.__lock():
+            rmtree_force(self.__folder)
+            if self.__ledger_file.exists():
+                self.__ledger_file.unlink()
+            # Including the lock of the ledger, processes waiting for it lock a new one
+            rmtree_force(self.__locks_folder)
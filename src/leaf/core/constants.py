@@ -34,6 +34,9 @@ class LeafSettings(CommonSettings):
     CACHE_AUTOCLEAN = LeafSetting(
         "leaf.cache.autoclean", "LEAF_CACHE_AUTOCLEAN", description="Leaf cache auto clean up", default=1, validator=RegexValidator("[0-1]")
     )
+    CACHE_VERIFY = LeafSetting(
+        "leaf.cache.verify", "LEAF_CACHE_VERIFY", description="Always check the hash of cached artifacts, even if they did not change since their last check"
+    )
     DEBUG_MODE = LeafSetting("leaf.debug", "LEAF_DEBUG", description="Enable traces")
     NON_INTERACTIVE = LeafSetting("leaf.noninteractive", "LEAF_NON_INTERACTIVE", description="Do not ask for confirmations, assume yes")
     DISABLE_LOCKS = LeafSetting("leaf.locks.disable", "LEAF_DISABLE_LOCKS", description="Disable lock files for install operations")
@@ -45,10 +48,46 @@ class LeafSettings(CommonSettings):
     DOWNLOAD_RETRY = LeafSetting(
         "leaf.download.retry", "LEAF_RETRY", description="Retry count for download operations", default=5, validator=RegexValidator("[0-9]+")
     )
+    DOWNLOAD_WORKERS = LeafSetting(
+        "leaf.download.workers",
+        "LEAF_DOWNLOAD_WORKERS",
+        description="Maximum number of concurrent downloads",
+        default=4,
+        validator=RegexValidator("[0-9]+"),
+    )
+    DOWNLOAD_SEGMENTS = LeafSetting(
+        "leaf.download.segments",
+        "LEAF_DOWNLOAD_SEGMENTS",
+        description="Number of byte ranges downloaded in parallel for large artifacts, 0 to disable",
+        default=0,
+        validator=RegexValidator("[0-9]+"),
+    )
+    DOWNLOAD_STREAM = LeafSetting(
+        "leaf.download.stream", "LEAF_DOWNLOAD_STREAM", description="Extract http(s) artifacts while they are downloaded, before installation"
+    )
+    DOWNLOAD_LOCAL_COPY = LeafSetting(
+        "leaf.download.local.copy",
+        "LEAF_DOWNLOAD_LOCAL_COPY",
+        description="Copy artifacts from local remotes instead of using hard links or reflinks",
+    )
     DOWNLOAD_NORESUME = LeafSetting("leaf.download.resume.disable", "LEAF_NORESUME", description="Disable resume when a download fails")
+    INSTALL_WORKERS = LeafSetting(
+        "leaf.install.workers",
+        "LEAF_INSTALL_WORKERS",
+        description="Maximum number of packages installed concurrently",
+        default=1,
+        validator=RegexValidator("[0-9]+"),
+    )
     GPG_KEYSERVER = LeafSetting(
         "leaf.gpg.server", "LEAF_GPG_KEYSERVER", description="Server where GPG keys will be fetched", default="subset.pool.sks-keyservers.net"
     )
+    BUILD_WORKERS = LeafSetting(
+        "leaf.build.workers",
+        "LEAF_BUILD_WORKERS",
+        description="Maximum number of processes used to compute artifacts hashes when building an index",
+        default=4,
+        validator=RegexValidator("[0-9]+"),
+    )
     CUSTOM_TAR = LeafSetting("leaf.build.tar", "LEAF_CUSTOM_TAR", description="Use custom tar binary instead of *tar* command when generating artifacts")
     CUSTOM_THEME = LeafSetting("leaf.theme", "LEAF_THEME", description="Custom color theme")
     PROFILE_NORELATIVE = LeafSetting(
@@ -81,8 +120,16 @@ class LeafConstants:
     COLORAMA_MIN_VERSION = "0.3.3"
     DEFAULT_PROFILE = "default"
     CACHE_SIZE_MAX = 5 * 1024 * 1024 * 1024  # 5GB
+    CACHE_SIZE_TARGET = 4 * 1024 * 1024 * 1024  # 4GB, size of the cache after eviction
+    CACHE_PARTIAL_MAX_AGE = 7 * 24 * 3600  # 7 days, interrupted downloads are not resumed after
     GPG_SIG_EXTENSION = ".asc"
     EXTINFO_EXTENSION = ".info"
+    PARTIAL_EXTENSION = ".part"
+    JOURNAL_EXTENSION = ".journal"
+    LEDGER_EXTENSION = ".ledger"
+    VALIDATORS_EXTENSION = ".validators"
+    COMPILED_EXTENSION = ".marshal"
+    REMOTE_FAILURE_DELAY = 3600  # 1 hour
     LATEST = "latest"
     DEFAULT_PAGER = pager = ("less", "-R", "-S", "-P", "Leaf -- Press q to exit")
 
@@ -104,11 +151,16 @@ class LeafFiles:
     # Configuration files
     CONFIG_FILENAME = "config.json"
     CACHE_DOWNLOAD_FOLDERNAME = "files"
+    CACHE_DOWNLOAD_LEDGER_FILENAME = "files.ledger"
+    CACHE_LOCKS_FOLDERNAME = "locks"
     CACHE_REMOTES_FOLDERNAME = "remotes"
+    CACHE_REMOTES_STATS_FILENAME = "remotes-stats.json"
+    CACHE_INSTALLED_INDEX_FILENAME = "installed-packages.json"
     THEMES_FILENAME = "themes.ini"
     PLUGINS_DIRNAME = "plugins"
     GPG_DIRNAME = "gpg"
     LOCK_FILENAME = "lock"
+    STAGING_FOLDERNAME = ".leaf-staging"
 
 
 class JsonConstants(object):
@@ -125,6 +177,10 @@ class JsonConstants(object):
     CONFIG_REMOTE_PRIORITY = "priority"
     CONFIG_REMOTE_ENABLED = "enabled"
     CONFIG_REMOTE_GPGKEY = "gpgKey"
+    # Remote download statistics
+    REMOTE_STATS_THROUGHPUT = "throughput"
+    REMOTE_STATS_LATENCY = "latency"
+    REMOTE_STATS_FAILURE = "lastFailure"
     CONFIG_ENV = "env"
 
     # Index
@@ -135,6 +191,7 @@ class JsonConstants(object):
     REMOTE_PACKAGE_SIZE = "size"
     REMOTE_PACKAGE_FILE = "file"
     REMOTE_PACKAGE_HASH = "hash"
+    REMOTE_PACKAGE_HASHES = "hashes"
 
     # Manifest
     INFO = "info"
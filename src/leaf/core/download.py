@@ -7,22 +7,42 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
+import fcntl
+import hashlib
 import os
 import shutil
+import socket
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from itertools import cycle, islice
 from pathlib import Path
+from threading import Event, Lock
+from urllib.error import URLError
 from urllib.parse import urlparse, urlunparse
-from urllib.request import urlopen
+from urllib.request import url2pathname, urlopen
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from leaf.core.constants import LeafSettings
+from leaf.core.constants import LeafConstants, LeafSettings
+from leaf.core.error import DownloadCancelledException, InvalidHashException, RangeNotSupportedException
+from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.core.logger import TextLogger, print_trace
-from leaf.core.utils import hash_check
+from leaf.core.utils import hash_check, hash_factory, hash_format, hash_update_file
+from leaf.rendering.formatutils import isatty, sizeof_fmt
 
 PRIORITIES_RANGE = range(1, 1000)
 PROTOCOLS_PRIORITIES = {"https": 200, "http": 201, "file": 100, "": 100}
 
+__HTTP_SESSION = None
+__HTTP_SESSION_LOCK = Lock()
+__HTTP_POOL_MAXSIZE = 10
+__HTTP_VALIDATORS = OrderedDict((("ETag", "If-None-Match"), ("Last-Modified", "If-Modified-Since")))
+__SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
 
 def get_url_priority(url: str):
     return PROTOCOLS_PRIORITIES.get(urlparse(url).scheme, 500)
@@ -38,61 +58,351 @@ def url_resolve(url: str, subpath: str):
     return urlunparse(url)
 
 
-def _download_file_generic(url: str, output: Path, logger: TextLogger):
-    _display_progress(logger, "Getting {0.name}".format(output))
-    with urlopen(url, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as stream:
-        with output.open("wb") as fp:
-            fp.write(stream.read())
-    # End the progress display
-    _display_progress(logger, "Getting {0.name}".format(output), 1, 1, end="\n")
+def get_http_session() -> requests.Session:
+    """
+    Return the process-wide http session.
+    Connections are kept alive and pooled per host, so that successive downloads
+    from the same server do not pay a new TCP/TLS handshake
+    """
+    global __HTTP_SESSION
+    with __HTTP_SESSION_LOCK:
+        if __HTTP_SESSION is None:
+            # Keep at least one connection per concurrent download
+            pool_maxsize = max(__HTTP_POOL_MAXSIZE, LeafSettings.DOWNLOAD_WORKERS.as_int())
+            session = requests.Session()
+            for prefix in ("http://", "https://"):
+                session.mount(prefix, HTTPAdapter(pool_maxsize=pool_maxsize))
+            __HTTP_SESSION = session
+        return __HTTP_SESSION
+
+
+def _copy_stream(stream, fp, hasher=None, buffer_size: int = 262144, callback: callable = None) -> int:
+    """
+    Copy the given stream to the output file by chunks, feeding the hasher if given
+    @return: the number of bytes written
+    """
+    out = 0
+    data = stream.read(buffer_size)
+    while len(data) > 0:
+        out += fp.write(data)
+        if hasher is not None:
+            hasher.update(data)
+        if callback is not None:
+            callback(out)
+        data = stream.read(buffer_size)
+    return out
+
+
+def _download_file_generic(
+    url: str,
+    output: Path,
+    logger: TextLogger,
+    retry: int = None,
+    progress: callable = None,
+    cancel: Event = None,
+    hasher_factory: callable = None,
+):
+    if retry is None:
+        retry = LeafSettings.DOWNLOAD_RETRY.as_int()
+
+    def attempt():
+        # Schemes handled by urllib cannot be resumed, the download restarts from the beginning
+        hasher = hasher_factory() if hasher_factory is not None else None
+        # Do not write into an existing file, it may be a hard link to another artifact
+        if output.exists():
+            output.unlink()
+        with urlopen(url, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as stream, output.open("wb") as fp:
+            size_total = int(stream.headers.get("content-length", -1)) if stream.headers is not None else -1
+
+            def callback(worked):
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelledException(url)
+                progress(worked, size_total)
+
+            size = _copy_stream(stream, fp, hasher=hasher, callback=callback)
+        if 0 < size < size_total:
+            raise ValueError("Incomplete download")
+        # End the progress display
+        progress(size, size)
+        return hasher
 
+    return _retry(attempt, logger, retry, url=url, cancel=cancel)
 
-def _download_file_local(url: str, output: Path, logger: TextLogger):
-    _display_progress(logger, "Copying {0.name}".format(output))
-    shutil.copy(str(url), str(output))
+
+# ioctl request to share the extents of a file on copy-on-write filesystems (btrfs, xfs)
+__FICLONE = 0x40049409
+
+
+def _clone_file(source: Path, output: Path) -> bool:
+    """
+    Create the output file without copying the source content through user space, using the first working method:
+    hard link, reflink, copy_file_range or sendfile
+    @return: False if none of these methods can be used
+    """
+    try:
+        os.link(str(source), str(output))
+        return True
+    except OSError:
+        pass
+    with source.open("rb") as src, output.open("wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), __FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+        size = os.fstat(src.fileno()).st_size
+        # copy_file_range is only available with python 3.8+
+        for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if copy is None:
+                continue
+            try:
+                offset = 0
+                while offset < size:
+                    if copy is os.sendfile:
+                        count = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    else:
+                        count = copy(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                    if count == 0:
+                        break
+                    offset += count
+                if offset == size:
+                    return True
+            except OSError:
+                pass
+            dst.seek(0)
+            dst.truncate()
+    return False
+
+
+def _download_file_local(
+    url: str, output: Path, logger: TextLogger, progress: callable = None, hasher_factory: callable = None, link: bool = False
+):
+    hasher = None
+    source = Path(url)
+    if output.exists():
+        output.unlink()
+    if link and not LeafSettings.DOWNLOAD_LOCAL_COPY.as_boolean() and _clone_file(source, output):
+        if hasher_factory is not None:
+            # The content still has to be verified
+            hasher = hasher_factory()
+            hash_update_file(hasher, output)
+    elif hasher_factory is None:
+        shutil.copy(str(source), str(output))
+    else:
+        # Compute the hash while copying to avoid reading the file twice
+        hasher = hasher_factory()
+        with source.open("rb") as stream, output.open("wb") as fp:
+            _copy_stream(stream, fp, hasher=hasher)
     # End the progress display
-    _display_progress(logger, "Copying {0.name}".format(output), 1, 1, end="\n")
+    size = output.stat().st_size
+    progress(size, size)
+    return hasher
+
+
+class _DownloadJournal:
+
+    """
+    Sidecar file of a partial http download.
+    It records the validator of the remote file (ETag or Last-Modified) and the digest of every downloaded chunk,
+    so that a download can be resumed later, even by another leaf process, without trusting a corrupted or outdated partial file
+    """
 
+    __CHUNK_SIZE = 4 * 1024 * 1024
 
-def _download_file_http(url: str, output: Path, logger: TextLogger, resume: bool = None, retry: int = None, buffer_size: int = 262144):
+    def __init__(self, file: Path):
+        self.__file = file
+        self.validator = None
+        self.__chunks = []
+        self.__hasher = hashlib.sha1()
+        self.__pending = 0
+        if file.exists():
+            try:
+                json = jloadfile(file)
+                if json.get("chunkSize") == _DownloadJournal.__CHUNK_SIZE:
+                    self.validator = json.get("validator")
+                    self.__chunks = json.get("chunks", [])
+            except Exception:
+                print_trace("Invalid download journal {file}".format(file=file))
+
+    def __save(self):
+        jwritefile(self.__file, {"validator": self.validator, "chunkSize": _DownloadJournal.__CHUNK_SIZE, "chunks": self.__chunks}, atomic=True)
+
+    def delete(self):
+        if self.__file.exists():
+            self.__file.unlink()
+
+    def owns(self, output: Path) -> bool:
+        """
+        Check if the partial file has been written by a download using this journal.
+        Other partial files must not be written into: they may be hard links to the artifact of a local remote
+        """
+        return len(self.__chunks) > 0 and output.stat().st_nlink == 1
+
+    def start(self, headers: dict):
+        """
+        A new download starts from the beginning
+        """
+        etag = headers.get("ETag")
+        # If-Range only accepts strong validators
+        self.validator = etag if etag is not None and not etag.startswith("W/") else headers.get("Last-Modified")
+        self.__chunks = []
+        self.__hasher = hashlib.sha1()
+        self.__pending = 0
+        self.__save()
+
+    def update(self, data: bytes):
+        """
+        Record downloaded data, appended to the file
+        """
+        view = memoryview(data)
+        while len(view) > 0:
+            count = min(len(view), _DownloadJournal.__CHUNK_SIZE - self.__pending)
+            self.__hasher.update(view[:count])
+            self.__pending += count
+            view = view[count:]
+            if self.__pending == _DownloadJournal.__CHUNK_SIZE:
+                self.__chunks.append(self.__hasher.hexdigest())
+                self.__hasher = hashlib.sha1()
+                self.__pending = 0
+                self.__save()
+
+    def verify(self, output: Path, repair: callable, hasher=None) -> int:
+        """
+        Check the partial file against the recorded digests, in a single pass.
+        Data after the last recorded chunk cannot be verified, it is removed.
+        Corrupted chunks are replaced by the content returned by repair(start, end), end being inclusive.
+        If a hasher is given, it is fed with the verified content
+        @return: the size of the verified partial file
+        """
+        chunk_size = _DownloadJournal.__CHUNK_SIZE
+        # The last chunks may be recorded before their data is flushed to the partial file
+        self.__chunks = self.__chunks[: output.stat().st_size // chunk_size]
+        self.__hasher = hashlib.sha1()
+        self.__pending = 0
+        size = len(self.__chunks) * chunk_size
+        with output.open("r+b") as fp:
+            fp.truncate(size)
+            for index, digest in enumerate(self.__chunks):
+                start = index * chunk_size
+                fp.seek(start)
+                data = fp.read(chunk_size)
+                if hashlib.sha1(data).hexdigest() != digest:
+                    data = repair(start, start + chunk_size - 1)
+                    fp.seek(start)
+                    fp.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+        self.__save()
+        return size
+
+
+def _download_file_http(
+    url: str,
+    output: Path,
+    logger: TextLogger,
+    resume: bool = None,
+    retry: int = None,
+    buffer_size: int = 262144,
+    progress: callable = None,
+    cancel: Event = None,
+    hasher_factory: callable = None,
+):
     # Handle default values
     if retry is None:
         retry = LeafSettings.DOWNLOAD_RETRY.as_int()
     if resume is None:
         resume = not LeafSettings.DOWNLOAD_NORESUME.as_boolean()
 
-    _display_progress(logger, "Downloading {0.name}".format(output))
+    journal_file = output.parent / (output.name + LeafConstants.JOURNAL_EXTENSION)
 
-    iteration = 0
-    while True:
-        try:
-            headers = {}
-            size_current = 0
-            if output.exists():
-                if resume:
-                    size_current = output.stat().st_size
+    def repair(journal: _DownloadJournal, start: int, end: int) -> bytes:
+        # Only fetch again the corrupted chunk, if the remote file did not change
+        if logger:
+            logger.print_verbose("Fetch corrupted range {0}-{1} of {2.name} again".format(start, end, output))
+        headers = {"Range": "bytes={0}-{1}".format(start, end)}
+        if journal.validator is not None:
+            headers["If-Range"] = journal.validator
+        with get_http_session().get(url, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as req:
+            if req.status_code != 206 or len(req.content) != end - start + 1:
+                # The partial file cannot be trusted anymore
+                output.unlink()
+                journal.delete()
+                raise ValueError("Cannot repair partial download")
+            return req.content
+
+    def attempt():
+        headers = {}
+        size_current = 0
+        hasher = hasher_factory() if hasher_factory is not None else None
+        journal = _DownloadJournal(journal_file) if resume else None
+        if output.exists():
+            if resume and journal.owns(output):
+                # Only the already downloaded part has to be read again, to be verified and hashed
+                size_current = journal.verify(output, lambda start, end: repair(journal, start, end), hasher=hasher)
+                if size_current > 0:
                     headers = {"Range": "bytes={0}-".format(size_current)}
-                else:
-                    output.unlink()
+                    if journal.validator is not None:
+                        # The server sends the whole file if it changed since the download started
+                        headers["If-Range"] = journal.validator
+            else:
+                output.unlink()
 
-            with output.open("ab" if resume else "wb") as fp:
-                req = requests.get(url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int())
-                # Get total size on first request
-                size_total = int(req.headers.get("content-length", -1)) + size_current
+        with output.open("ab" if resume else "wb") as fp, get_http_session().get(
+            url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()
+        ) as req:
+            if size_current > 0 and req.status_code == 416:
+                # Range cannot be satisfied, restart the download from scratch
+                output.unlink()
+                journal.delete()
+                raise ValueError("Cannot resume download")
+            if size_current > 0 and req.status_code != 206:
+                # Server does not support range requests or the file changed, restart from the beginning
+                fp.seek(0)
+                fp.truncate()
+                size_current = 0
+                hasher = hasher_factory() if hasher_factory is not None else None
+            if size_current == 0 and journal is not None:
+                journal.start(req.headers)
 
-                # Read remote data and write to output file
-                for data in req.iter_content(buffer_size):
-                    size_current += fp.write(data)
-                    _display_progress(logger, "Downloading {0.name}".format(output), size_current, size_total)
+            # Get total size on first request
+            size_total = int(req.headers.get("content-length", -1)) + size_current
 
-                # Rare case when no exception raised and download is not finished
-                if 0 < size_current < size_total:
-                    raise ValueError("Incomplete download")
+            # Read remote data and write to output file
+            for data in req.iter_content(buffer_size):
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelledException(url)
+                size_current += fp.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                if journal is not None:
+                    journal.update(data)
+                progress(size_current, size_total)
+
+            # Rare case when no exception raised and download is not finished
+            if 0 < size_current < size_total:
+                raise ValueError("Incomplete download")
 
-                # End the progress display
-                _display_progress(logger, "Downloading {0.name}".format(output), 1, 1, end="\n")
-                return size_current
-        except (ValueError, requests.RequestException, requests.ConnectionError, requests.HTTPError, requests.Timeout) as e:
+            # End the progress display
+            progress(size_current, size_current)
+        if journal is not None:
+            journal.delete()
+        return hasher
+
+    return _retry(attempt, logger, retry, url=url, cancel=cancel)
+
+
+def _retry(func: callable, logger: TextLogger, retry: int, url: str = None, cancel: Event = None):
+    """
+    Call the given function, and call it again if a network error occurs, up to *retry* times
+    If the cancel event is set, no other attempt is made
+    """
+    iteration = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelledException(url)
+        try:
+            return func()
+        except (ValueError, requests.RequestException, requests.ConnectionError, requests.HTTPError, requests.Timeout, URLError, socket.timeout) as e:
             iteration += 1
             # Check retry
             if iteration > retry:
@@ -101,56 +411,431 @@ def _download_file_http(url: str, output: Path, logger: TextLogger, resume: bool
             if logger:
                 logger.print_default("\nError while downloading, retry {0}/{1}".format(iteration, retry))
             print_trace()
-            # Prevent imediate retry
-            time.sleep(1)
+            # Prevent imediate retry, unless the download is cancelled meanwhile
+            if cancel is not None:
+                cancel.wait(1)
+            else:
+                time.sleep(1)
 
 
-def download_file(url: str, output: Path, logger: TextLogger = None):
+def download_file(
+    url: str,
+    output: Path,
+    logger: TextLogger = None,
+    progress: callable = None,
+    cancel: Event = None,
+    hasher_factory: callable = None,
+    retry: int = None,
+    link: bool = False,
+):
+    """
+    Download the given url to the output file.
+    If a progress callback is given, it is called with (worked, total) instead of displaying the progress
+    If a cancel event is given, the download is interrupted as soon as it is set
+    If a hasher factory is given, the content is hashed while being downloaded
+    If retry is given, it overrides the retry count of remote downloads
+    If link is set, local files may be hard linked or cloned instead of copied, the output file must not be modified
+    @return: the hasher fed with the file content, or None if no hasher factory is given
+    """
     # Create parent folder if needed
     if not output.parent.exists():
-        output.parent.mkdir(parents=True)
+        output.parent.mkdir(parents=True, exist_ok=True)
     # Parse url to get the protocole
     parsedurl = urlparse(url)
-    if parsedurl.scheme == "":
+    if parsedurl.scheme in ("", "file"):
         # file mode, simple file copy
-        _download_file_local(parsedurl.path, output, logger=logger)
-    elif parsedurl.scheme.startswith("http"):
+        path = parsedurl.path if parsedurl.scheme == "" else url2pathname(parsedurl.path)
+        with _progress_display(logger, progress, "Copying {0.name}".format(output)) as progress:
+            return _download_file_local(path, output, logger=logger, progress=progress, hasher_factory=hasher_factory, link=link)
+    if parsedurl.scheme.startswith("http"):
         # http/https mode, get file length before
-        _download_file_http(url, output, logger=logger)
-    else:
-        # other scheme, use urllib
-        _download_file_generic(url, output, logger=logger)
+        with _progress_display(logger, progress, "Downloading {0.name}".format(output)) as progress:
+            return _download_file_http(url, output, logger=logger, retry=retry, progress=progress, cancel=cancel, hasher_factory=hasher_factory)
+    # other scheme, use urllib
+    with _progress_display(logger, progress, "Getting {0.name}".format(output)) as progress:
+        return _download_file_generic(url, output, logger=logger, retry=retry, progress=progress, cancel=cancel, hasher_factory=hasher_factory)
 
 
-def download_and_verify_file(url: str, output: Path, logger: TextLogger = None, hashstr: str = None):
+def download_file_segmented(
+    urls: list,
+    output: Path,
+    size: int,
+    segments: int,
+    logger: TextLogger = None,
+    progress: callable = None,
+    cancel: Event = None,
+    retry: int = None,
+    buffer_size: int = 262144,
+):
+    """
+    Download a file of the given size by splitting it in byte ranges fetched in parallel.
+    Ranges are spread over the given http(s) urls, which must all serve the same content.
+    If an url fails, its ranges are downloaded from the other urls.
+    Since ranges are received out of order, the file content has to be verified once complete.
+    @raise RangeNotSupportedException: if a server does not honor range requests
+    """
+    with _progress_display(logger, progress, "Downloading {0.name}".format(output)) as progress:
+        if retry is None:
+            retry = LeafSettings.DOWNLOAD_RETRY.as_int()
+        output.parent.mkdir(parents=True, exist_ok=True)
+
+        step = -(-size // max(1, segments))
+        ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+        worked = [0] * len(ranges)
+        lock = Lock()
+        abort = Event()
+        failed_urls = set()
+
+        # Allocate the whole file so that each range can be written at its offset
+        if output.exists():
+            output.unlink()
+        with output.open("wb") as fp:
+            fp.truncate(size)
+
+        def fetch(index: int):
+            start, end = ranges[index]
+
+            def attempt(url: str):
+                # On retry, only request the missing part of the range
+                offset = start + worked[index]
+                headers = {"Range": "bytes={0}-{1}".format(offset, end)}
+                with output.open("r+b") as fp, get_http_session().get(
+                    url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()
+                ) as req:
+                    if req.status_code != 206:
+                        raise RangeNotSupportedException(url)
+                    fp.seek(offset)
+                    for data in req.iter_content(buffer_size):
+                        if abort.is_set() or (cancel is not None and cancel.is_set()):
+                            raise DownloadCancelledException(url)
+                        fp.write(data)
+                        with lock:
+                            worked[index] += len(data)
+                            progress(sum(worked), size)
+                if start + worked[index] <= end:
+                    raise ValueError("Incomplete download")
+
+            # Start with the url assigned to the range, then use the other ones
+            error = None
+            for url in islice(cycle(urls), index, index + len(urls)):
+                if url in failed_urls:
+                    continue
+                try:
+                    return _retry(partial(attempt, url), logger, retry, url=url, cancel=cancel)
+                except (DownloadCancelledException, RangeNotSupportedException):
+                    raise
+                except Exception as e:
+                    error = e
+                    failed_urls.add(url)
+                    if logger:
+                        logger.print_verbose("\nCannot download range {0}-{1} from {2}, try another url".format(start, end, url))
+            raise error if error is not None else ValueError("No url left to download {0.name}".format(output))
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch, i) for i in range(len(ranges))]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Stop the other ranges as soon as one fails
+                abort.set()
+                raise
+
+        # End the progress display
+        progress(size, size)
+
+
+def _get_segments_count(urls: list, size: int) -> int:
+    """
+    Return the number of ranges to use to download a file of the given size, 0 or 1 meaning a simple download
+    """
+    if size is None or not all(urlparse(url).scheme.startswith("http") for url in urls):
+        return 0
+    return min(LeafSettings.DOWNLOAD_SEGMENTS.as_int(), size // __SEGMENT_MIN_SIZE)
+
+
+def download_file_if_modified(url: str, output: Path, validators: dict = None, logger: TextLogger = None, buffer_size: int = 262144):
+    """
+    Download the given url only if its content changed since the given validators (ETag, Last-Modified) were returned.
+    Validators are only supported by http(s) urls, other urls are always downloaded.
+    If the content has not been modified, the output file is only touched.
+    @return: a tuple (modified, validators) where validators are the ones to give for the next download
+    """
+    if not urlparse(url).scheme.startswith("http"):
+        download_file(url, output, logger=logger)
+        return True, None
+
+    # Create parent folder if needed
+    output.parent.mkdir(parents=True, exist_ok=True)
+    headers = {}
+    if validators is not None and output.exists():
+        for validator, condition in __HTTP_VALIDATORS.items():
+            if validator in validators:
+                headers[condition] = validators[validator]
+
+    def attempt():
+        with get_http_session().get(url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as req:
+            if req.status_code == 304:
+                # Content has not changed, touch the file to keep track of the check
+                output.touch()
+                return False, validators
+            with output.open("wb") as fp:
+                for data in req.iter_content(buffer_size):
+                    fp.write(data)
+            return True, {v: req.headers[v] for v in __HTTP_VALIDATORS if v in req.headers}
+
+    return _retry(attempt, logger, LeafSettings.DOWNLOAD_RETRY.as_int())
+
+
+def download_and_verify_file(
+    url: str,
+    output: Path,
+    logger: TextLogger = None,
+    hashstr: str = None,
+    progress: callable = None,
+    cancel: Event = None,
+    mirrors: list = None,
+    size: int = None,
+    retry: int = None,
+    trusted: bool = False,
+):
     """
     Download an artifact and check its hash if given
+    If segmented downloads are enabled and the artifact size is known, large artifacts are
+    downloaded by ranges spread over the url and its mirrors
+    If trusted, an existing output file has already been verified and is not hashed again
+    The artifact is downloaded in a temporary file, renamed once verified, so that the output file is always complete.
+    An interrupted download is resumed from the temporary file
     """
     if output.exists():
         if hashstr is None:
             logger.print_verbose("File exists but cannot be verified, {file.name} will be re-downloaded".format(file=output))
             os.remove(str(output))
-        elif not hash_check(output, hashstr, raise_exception=False):
+        elif not trusted and not hash_check(output, hashstr, raise_exception=False):
             logger.print_verbose("File exists but hash differs, {file.name} will be re-downloaded".format(file=output))
             os.remove(str(output))
         else:
             logger.print_verbose("File {file.name} is already downloaded".format(file=output))
+            if progress is not None:
+                size = output.stat().st_size
+                progress(size, size)
+
+    if output.exists():
+        return output
+
+    partfile = output.parent / (output.name + LeafConstants.PARTIAL_EXTENSION)
+    try:
+        urls = [url] + [m for m in (mirrors or []) if m != url]
+        segments = _get_segments_count(urls, size)
+        # An existing partial file comes from an interrupted simple download, resume it
+        if segments > 1 and not partfile.exists():
+            try:
+                download_file_segmented(urls, partfile, size, segments, logger=logger, progress=progress, cancel=cancel, retry=retry)
+                if hashstr:
+                    hash_check(partfile, hashstr, raise_exception=True)
+                partfile.replace(output)
+                return output
+            except RangeNotSupportedException as e:
+                if logger:
+                    logger.print_verbose("{0}, use a simple download".format(e.message))
+                partfile.unlink()
+            except BaseException as e:
+                # Ranges are not contiguous, the partial file cannot be resumed
+                if partfile.exists():
+                    partfile.unlink()
+                raise e
 
-    if not output.exists():
-        download_file(url, output, logger=logger)
         if hashstr:
-            hash_check(output, hashstr, raise_exception=True)
+            hasher = download_file(
+                url, partfile, logger=logger, progress=progress, cancel=cancel, hasher_factory=hash_factory(hashstr), retry=retry, link=True
+            )
+            # The hash has been computed during the download, no need to read the file again
+            hash_check(partfile, hashstr, raise_exception=True, actual=hash_format(hasher))
+        else:
+            download_file(url, partfile, logger=logger, progress=progress, cancel=cancel, retry=retry, link=True)
+    except InvalidHashException as e:
+        # Do not resume an invalid file
+        if partfile.exists():
+            partfile.unlink()
+        raise e
+    except BaseException as e:
+        # A partial file linked to the artifact of a local remote must not be left for other downloads
+        if partfile.exists() and partfile.stat().st_nlink > 1:
+            partfile.unlink()
+        raise e
+    partfile.replace(output)
     return output
 
 
-def _display_progress(logger: TextLogger, message: str, worked: int = None, total: int = None, end: str = "", try_percent=True):
-    if logger:
-        if worked is None or total is None:
-            logger.print_default(message, end=end, flush=True)
+class _TeeStream:
+
+    """
+    Readable stream which copies all data read from the source to the output file and the hasher
+    """
+
+    def __init__(self, source, fp, hasher=None, callback: callable = None, cancel: Event = None, url: str = None):
+        self.__source = source
+        self.__fp = fp
+        self.__hasher = hasher
+        self.__callback = callback
+        self.__cancel = cancel
+        self.__url = url
+        self.worked = 0
+
+    def read(self, size: int = -1):
+        if self.__cancel is not None and self.__cancel.is_set():
+            raise DownloadCancelledException(self.__url)
+        data = self.__source.read(size if size >= 0 else None)
+        self.worked += self.__fp.write(data)
+        if self.__hasher is not None:
+            self.__hasher.update(data)
+        if self.__callback is not None:
+            self.__callback(self.worked)
+        return data
+
+    def drain(self, buffer_size: int = 262144):
+        """
+        Read the remaining data
+        """
+        while len(self.read(buffer_size)) > 0:
+            pass
+
+
+def download_and_stream_file(
+    url: str,
+    output: Path,
+    consumer: callable,
+    logger: TextLogger = None,
+    hashstr: str = None,
+    progress: callable = None,
+    cancel: Event = None,
+    buffer_size: int = 262144,
+):
+    """
+    Download the given http(s) url to the output file in a single pass, while its content is hashed
+    and given to the consumer as a readable stream.
+    There is no resume nor retry, the caller should use a regular download on network errors.
+    The content is written in a temporary file, renamed once verified
+    @raise InvalidHashException: if the content does not match the given hash
+    """
+    with _progress_display(logger, progress, "Downloading {0.name}".format(output)) as progress:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        partfile = output.parent / (output.name + LeafConstants.PARTIAL_EXTENSION)
+        hasher = hash_factory(hashstr)() if hashstr else None
+        # The partial file is written from the beginning, without journal it cannot be resumed by a regular download
+        for file in (partfile, output.parent / (output.name + LeafConstants.JOURNAL_EXTENSION)):
+            if file.exists():
+                file.unlink()
+
+        with partfile.open("wb") as fp, get_http_session().get(url, stream=True, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as req:
+            req.raise_for_status()
+            req.raw.decode_content = True
+            size_total = int(req.headers.get("content-length", -1))
+            stream = _TeeStream(req.raw, fp, hasher=hasher, callback=lambda worked: progress(worked, size_total), cancel=cancel, url=url)
+            consumer(stream)
+            # The consumer may not read the data up to the end, like the padding of a tar archive
+            stream.drain(buffer_size)
+
+        if 0 < stream.worked < size_total:
+            raise ValueError("Incomplete download")
+        progress(stream.worked, stream.worked)
+        if hasher is not None:
+            try:
+                hash_check(partfile, hashstr, raise_exception=True, actual=hash_format(hasher))
+            except InvalidHashException as e:
+                partfile.unlink()
+                raise e
+        partfile.replace(output)
+
+
+class DownloadProgress:
+
+    """
+    Aggregate the progress of several concurrent downloads in a single status line, with throughput and ETA.
+    Redraws are throttled by time: on a terminal the status line is refreshed at most every REFRESH_TTY seconds,
+    otherwise a summary line is printed every REFRESH_NOTTY seconds
+    """
+
+    REFRESH_TTY = 0.2
+    REFRESH_NOTTY = 10
+
+    def __init__(self, logger: TextLogger, message: str, tty: bool = None, interval: float = None):
+        self.__logger = logger
+        self.__message = message
+        self.__tty = isatty() if tty is None else tty
+        if interval is None:
+            interval = DownloadProgress.REFRESH_TTY if self.__tty else DownloadProgress.REFRESH_NOTTY
+        self.__interval = interval
+        self.__lock = Lock()
+        self.__transfers = OrderedDict()
+        self.__start = time.monotonic()
+        # On a terminal, the status line is displayed as soon as the first data is received
+        self.__last_display = None if self.__tty else self.__start
+        self.__width = 0
+
+    def create(self, key, size: int = None) -> callable:
+        """
+        Register a new transfer and return the progress callback to give to download functions
+        """
+        with self.__lock:
+            self.__transfers[key] = (0, size or 0)
+        return lambda worked, total: self.__update(key, worked, total)
+
+    def __update(self, key, worked: int, total: int):
+        with self.__lock:
+            self.__transfers[key] = (worked, max(worked, total))
+            now = time.monotonic()
+            if self.__last_display is None or now - self.__last_display >= self.__interval:
+                self.__last_display = now
+                self.__display(now)
+
+    def end(self):
+        """
+        Terminate the progress display
+        """
+        with self.__lock:
+            self.__display(time.monotonic(), done=True)
+
+    def __display(self, now: float, done: bool = False):
+        if self.__logger is None:
+            return
+        line = self.__format(now, done)
+        if self.__tty:
+            # Pad the line to erase the previous one
+            self.__width = max(self.__width, len(line))
+            self.__logger.print_default("\r" + line.ljust(self.__width), end="\n" if done else "", flush=True)
         else:
-            kwargs = {"message": message, "worked": worked, "total": total, "progress": "??"}
-            if try_percent and 0 <= worked <= total and total > 0:
-                kwargs["progress"] = "{0:.0%}".format(worked / total)
-            else:
-                kwargs["progress"] = "{0}/{1}".format(worked, total)
-            logger.print_default("\r[{progress}] {message} ".format(**kwargs), end=end, flush=True)
+            self.__logger.print_default(line, flush=True)
+
+    def __format(self, now: float, done: bool) -> str:
+        worked = sum(w for w, _ in self.__transfers.values())
+        total = sum(t for _, t in self.__transfers.values())
+        if 0 <= worked <= total and total > 0:
+            progress = "{0:.0%}".format(worked / total)
+        else:
+            # Empty or unknown size
+            progress = "100%" if done else "??"
+        details = [sizeof_fmt(worked) if total <= 0 else "{0}/{1}".format(sizeof_fmt(worked), sizeof_fmt(total))]
+        elapsed = now - self.__start
+        if worked > 0 and elapsed > 0:
+            speed = worked / elapsed
+            details.append("{0}/s".format(sizeof_fmt(int(speed))))
+            if not done and worked < total:
+                eta = int((total - worked) / speed)
+                details.append("ETA {0}:{1:02}:{2:02}".format(eta // 3600, eta // 60 % 60, eta % 60))
+        return "[{progress}] {message} ({details})".format(progress=progress, message=self.__message, details=", ".join(details))
+
+
+@contextmanager
+def _progress_display(logger: TextLogger, progress: callable, message: str):
+    """
+    Give the progress callback to use: the given one, or the callback of a new display terminated on exit
+    """
+    if progress is not None:
+        yield progress
+        return
+    display = DownloadProgress(logger, message)
+    try:
+        yield display.create(message)
+    finally:
+        display.end()
@@ -154,6 +154,16 @@ class InvalidHashException(LeafException):
         )
 
 
+class DownloadCancelledException(LeafException):
+    def __init__(self, url):
+        LeafException.__init__(self, "Download of {url} has been cancelled".format(url=url))
+
+
+class RangeNotSupportedException(LeafException):
+    def __init__(self, url):
+        LeafException.__init__(self, "Server does not support range requests for {url}".format(url=url))
+
+
 class LockException(LeafException):
     def __init__(self, lockfile):
         LeafException.__init__(self, "leaf is already running another operation (lock: {file})".format(file=lockfile))
@@ -11,6 +11,8 @@ import json
 from collections import OrderedDict
 from pathlib import Path
 
+from leaf.core.utils import fs_atomic_write
+
 __JSON_LOAD_ARGS = {"object_pairs_hook": OrderedDict}
 __JSON_DUMP_PP = {"indent": 4, "separators": (",", ": ")}
 
@@ -20,8 +22,11 @@ def jtostring(data: dict, pp: bool = False):
     return json.dumps(data, **kw)
 
 
-def jwritefile(file: Path, data: dict, pp: bool = False):
-    with file.open("w") as fp:
+def jwritefile(file: Path, data: dict, pp: bool = False, atomic: bool = False):
+    """
+    Write the data to the file, if atomic is set the file is replaced once completely written
+    """
+    with fs_atomic_write(file) if atomic else file.open("w") as fp:
         fp.write(jtostring(data, pp=pp))
 
 
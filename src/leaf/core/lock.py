@@ -8,6 +8,7 @@ Leaf Package Manager
 """
 
 import fcntl
+import os
 from contextlib import ContextDecorator
 from pathlib import Path
 
@@ -29,11 +30,23 @@ class AdvisoryLock(ContextDecorator):
 
     def __enter__(self):
         if self.lockfile is not None and not self.disabled:
-            self.fp = self.lockfile.open("w")
-            try:
-                self.lockFunction(self.fp, fcntl.LOCK_EX | self.flags)
-            except BlockingIOError:
-                raise LockException(self.lockfile)
+            while True:
+                self.fp = self.lockfile.open("w")
+                try:
+                    self.lockFunction(self.fp, fcntl.LOCK_EX | self.flags)
+                except BlockingIOError:
+                    self.fp.close()
+                    raise LockException(self.lockfile)
+                if self.__is_current():
+                    return
+                # The lock file has been removed by its previous owner, lock the new one
+                self.fp.close()
+
+    def __is_current(self):
+        try:
+            return os.path.samestat(os.stat(str(self.lockfile)), os.fstat(self.fp.fileno()))
+        except FileNotFoundError:
+            return False
 
     def __exit__(self, *exc):
         if self.lockfile is not None and not self.disabled:
@@ -10,6 +10,7 @@ Leaf Package Manager
 import sys
 import traceback
 from enum import IntEnum, unique
+from io import StringIO
 
 from leaf.core.constants import LeafSettings
 
@@ -44,24 +45,66 @@ class TextLogger:
     def verbosity(self):
         return Verbosity.get_current()
 
+    @property
+    def stdout(self):
+        """
+        Stream where the output of executed commands should be written, None for the standard output
+        """
+        return None
+
     def isquiet(self):
         return self.verbosity == Verbosity.QUIET
 
     def isverbose(self):
         return self.verbosity == Verbosity.VERBOSE
 
+    def _print(self, *message, **kwargs):
+        print(*message, **kwargs)
+
     def print_quiet(self, *message, **kwargs):
         if self.verbosity >= Verbosity.QUIET:
-            print(*message, **kwargs)
+            self._print(*message, **kwargs)
 
     def print_default(self, *message, **kwargs):
         if self.verbosity >= Verbosity.DEFAULT:
-            print(*message, **kwargs)
+            self._print(*message, **kwargs)
 
     def print_verbose(self, *message, **kwargs):
         if self.verbosity >= Verbosity.VERBOSE:
-            print(*message, **kwargs)
+            self._print(*message, **kwargs)
 
     def print_error(self, *message):
-        print(*message, file=sys.stderr)
+        self._print(*message, file=sys.stderr)
         print_trace()
+
+
+class BufferedLogger(TextLogger):
+
+    """
+    Logger keeping messages until they are flushed, so that the output of concurrent tasks is not interleaved
+    """
+
+    def __init__(self):
+        self.__messages = []
+
+    @property
+    def stdout(self):
+        return self
+
+    def write(self, text: str):
+        self.__messages.append((None, text))
+
+    def _print(self, *message, file=None, flush=False, **kwargs):
+        buffer = StringIO()
+        print(*message, file=buffer, **kwargs)
+        self.__messages.append((file, buffer.getvalue()))
+
+    def flush(self):
+        """
+        Print all messages kept so far
+        """
+        for file, text in self.__messages:
+            (file or sys.stdout).write(text)
+        self.__messages = []
+        sys.stdout.flush()
+        sys.stderr.flush()
@@ -16,9 +16,12 @@ import string
 import sys
 import time
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from functools import total_ordering
 from itertools import zip_longest
 from pathlib import Path
+from threading import get_ident
 
 from leaf import __version__
 from leaf.core.constants import LeafConstants
@@ -26,6 +29,8 @@ from leaf.core.error import InvalidHashException, LeafException, NotEnoughSpaceE
 
 _IGNORED_PATTERN = re.compile("^.*_ignored[0-9]*$")
 _VERSION_SEPARATOR = re.compile("[-_.~]")
+# Timestamps are not precise enough to detect changes made right after a modification
+_RACY_DELAY = 2
 
 
 @total_ordering
@@ -191,6 +196,37 @@ def fs_check_free_space(folder: Path, neededspace: int):
         raise NotEnoughSpaceException(folder, freespace, neededspace)
 
 
+def fs_get_identity(item: Path) -> list:
+    """
+    Return the identity of a file or folder, which changes when it is modified: inode, size and modification time
+    """
+    stat = item.stat()
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def fs_is_racy(identity: list) -> bool:
+    """
+    Check if the item was modified too recently for its identity to detect further changes
+    """
+    return identity[-1] > (time.time() - _RACY_DELAY) * 1e9
+
+
+@contextmanager
+def fs_atomic_write(file: Path, mode: str = "w"):
+    """
+    Open a temporary file which replaces the given file when the block succeeds
+    The file may be written concurrently by several threads or processes, readers only see complete files
+    """
+    tmpfile = file.parent / "{name}.{pid}.{thread}.tmp".format(name=file.name, pid=os.getpid(), thread=get_ident())
+    try:
+        with tmpfile.open(mode) as fp:
+            yield fp
+        tmpfile.replace(file)
+    finally:
+        if tmpfile.exists():
+            tmpfile.unlink()
+
+
 def chmod_write(item: Path):
     if item.exists() and not item.is_symlink():
         item.chmod(item.stat().st_mode | 0o222)
@@ -208,38 +244,121 @@ def rmtree_force(item: Path):
 
 
 __HASH_NAME = "sha384"
-__HASH_FACTORY = hashlib.sha384
-__HASH_LEN = 96
-__HASH_BLOCKSIZE = 4096
+# Supported hash methods, the fastest first, with their factory and their hex digest length
+__HASH_METHODS = OrderedDict()
+if hasattr(hashlib, "blake2b"):
+    __HASH_METHODS["blake2b"] = (hashlib.blake2b, 128)
+__HASH_METHODS[__HASH_NAME] = (hashlib.sha384, 96)
+__HASH_BLOCKSIZE = 1024 * 1024
+
+
+def hash_methods() -> list:
+    """
+    Return the supported hash methods, the fastest first
+    """
+    return list(__HASH_METHODS.keys())
 
 
 def hash_parse(hashstr: str):
     parts = hashstr.split(":")
     if len(parts) != 2:
         raise LeafException("Invalid hash format {hash}".format(hash=hashstr))
-    if parts[0] != __HASH_NAME:
-        raise LeafException("Unsupported hash method, expecting {hash}".format(hash=__HASH_NAME))
-    if len(parts[1]) != __HASH_LEN:
-        raise LeafException("Hash value '{hash}' has not the correct length, expecting {len}".format(hash=parts[1], len=__HASH_LEN))
+    if parts[0] not in __HASH_METHODS:
+        raise LeafException("Unsupported hash method, expecting {hash}".format(hash=", ".join(__HASH_METHODS.keys())))
+    hash_len = __HASH_METHODS[parts[0]][1]
+    if len(parts[1]) != hash_len:
+        raise LeafException("Hash value '{hash}' has not the correct length, expecting {len}".format(hash=parts[1], len=hash_len))
     return parts
 
 
-def hash_compute(file: Path):
+def hash_select(hashes: list) -> str:
+    """
+    Return the hash using the fastest supported method among the given hashes, None if no hash can be used
+    """
+    supported = [h for h in hashes if h is not None and h.split(":")[0] in __HASH_METHODS]
+    if len(supported) == 0:
+        return None
+    methods = hash_methods()
+    return min(supported, key=lambda h: methods.index(h.split(":")[0]))
+
+
+def hash_factory(hashstr: str) -> callable:
+    """
+    Return the hasher factory for the method used in the given hash
+    """
+    return __HASH_METHODS[hash_parse(hashstr)[0]][0]
+
+
+def hash_format(hasher) -> str:
+    """
+    Return the hash string of the content fed to the given hasher
+    """
+    return hasher.name + ":" + hasher.hexdigest()
+
+
+def hash_update_file(hasher, file: Path):
+    """
+    Feed the hasher, or the list of hashers, with the given file content
+    """
+    hashers = hasher if isinstance(hasher, (list, tuple)) else [hasher]
+    # Read large blocks in a reused buffer, to limit syscalls and allocations
+    buf = bytearray(__HASH_BLOCKSIZE)
+    view = memoryview(buf)
+    with file.open("rb", buffering=0) as fp:
+        count = fp.readinto(buf)
+        while count:
+            for h in hashers:
+                h.update(view[:count])
+            count = fp.readinto(buf)
+
+
+def hash_compute(file: Path, method: str = None, methods: list = None):
+    """
+    Return the hash of the given file, using sha384 if no method is given
+    If a list of methods is given, return the list of hashes, all computed while reading the file once
+    """
+    hashers = []
+    for m in methods if methods is not None else [method]:
+        m = m or __HASH_NAME
+        if m not in __HASH_METHODS:
+            raise LeafException("Unsupported hash method {method}".format(method=m))
+        hashers.append(__HASH_METHODS[m][0]())
+    hash_update_file(hashers, file)
+    out = [hash_format(h) for h in hashers]
+    return out if methods is not None else out[0]
+
+
+def hash_compute_all(files: list, workers: int = 1, progress: callable = None, method: str = None, methods: list = None) -> list:
     """
-    Return the hash of the given file
+    Return the hashes of the given files, in the same order, see hash_compute for method and methods
+    If more than one worker is given, files are hashed concurrently by a pool of processes
+    The progress callback is called with the file, the count of hashed files and the total count
     """
-    hasher = __HASH_FACTORY()
-    with file.open("rb") as fp:
-        buf = fp.read(__HASH_BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = fp.read(__HASH_BLOCKSIZE)
-    return __HASH_NAME + ":" + hasher.hexdigest()
+    out = [None] * len(files)
+    if workers <= 1 or len(files) <= 1:
+        for index, file in enumerate(files):
+            out[index] = hash_compute(file, method=method, methods=methods)
+            if progress is not None:
+                progress(file, index + 1, len(files))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            futures = {executor.submit(hash_compute, file, method=method, methods=methods): index for index, file in enumerate(files)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                out[index] = future.result()
+                if progress is not None:
+                    progress(files[index], done, len(files))
+    return out
 
 
-def hash_check(file: Path, expected: str, raise_exception: bool = False):
-    hash_parse(expected)
-    actual = hash_compute(file)
+def hash_check(file: Path, expected: str, raise_exception: bool = False, actual: str = None):
+    """
+    Check the hash of the given file.
+    If the actual hash is given (ie computed while the file was written), the file is not read again
+    """
+    method = hash_parse(expected)[0]
+    if actual is None:
+        actual = hash_compute(file, method=method)
     if actual != expected:
         if raise_exception is True:
             raise InvalidHashException(file, actual, expected)
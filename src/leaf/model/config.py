@@ -7,30 +7,67 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
+import pickle
 from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
 
 from leaf.core.constants import JsonConstants
 from leaf.core.error import LeafOutOfDateException
 from leaf.core.jsonutils import JsonObject, jlayer_diff, jlayer_update, jloadfile, jwritefile
 from leaf.core.logger import print_trace
-from leaf.core.utils import CURRENT_LEAF_VERSION, Version
+from leaf.core.utils import CURRENT_LEAF_VERSION, Version, fs_get_identity, fs_is_racy
 from leaf.model.environment import IEnvProvider
 from leaf.model.migration import update_root_folder, update_packages_map
 
+__LAYERS_CACHE = {}
+__LAYERS_CACHE_LOCK = Lock()
+
+
+def _load_layers(layers: tuple) -> tuple:
+    """
+    Merge the existing layers
+    The merged model is kept in memory as long as the layer files are unchanged.
+    It is kept serialized: unpickling gives a new model, which callers can modify, faster than parsing the layers again
+    @return: a tuple (model, existing layers), model being None if no layer exists
+    """
+    exist_layers = []
+    identities = []
+    for layer in layers:
+        if layer is not None and layer.is_file():
+            exist_layers.append(str(layer))
+            identities.append(fs_get_identity(layer))
+    if len(exist_layers) == 0:
+        return None, exist_layers
+
+    key = tuple(exist_layers)
+    with __LAYERS_CACHE_LOCK:
+        cached = __LAYERS_CACHE.get(key)
+    if cached is not None and cached[0] == identities:
+        return pickle.loads(cached[1]), exist_layers
+
+    model = None
+    for layer in exist_layers:
+        if model is None:
+            model = jloadfile(Path(layer))
+        else:
+            jlayer_update(model, jloadfile(Path(layer)))
+    if not any(fs_is_racy(identity) for identity in identities):
+        # The data is only produced and read by this process
+        data = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        with __LAYERS_CACHE_LOCK:
+            __LAYERS_CACHE[key] = (identities, data)
+    return model, exist_layers
+
+
+def _clear_layers_cache():
+    with __LAYERS_CACHE_LOCK:
+        __LAYERS_CACHE.clear()
+
 
 class ConfigFileWithLayer(JsonObject):
     def __init__(self, *layers: Path, default_factory=OrderedDict):
-        model = None
-        self.exist_layers = []
-        for layer in layers:
-            if layer is not None and layer.is_file():
-                if model is None:
-                    model = jloadfile(layer)
-                else:
-                    jlayer_update(model, jloadfile(layer))
-                self.exist_layers.append(str(layer))
-
+        model, self.exist_layers = _load_layers(layers)
         if model is None:
             model = default_factory()
         JsonObject.__init__(self, model)
@@ -68,6 +105,8 @@ class ConfigFileWithLayer(JsonObject):
             data = jlayer_diff(jloadfile(previous_layer), self.json)
         # Write layer
         jwritefile(output, data, pp=pp)
+        # The written file may be renamed over a cached layer
+        _clear_layers_cache()
 
     @property
     def leaf_min_version(self):
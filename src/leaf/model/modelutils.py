@@ -1,6 +1,8 @@
 import operator
 import subprocess
+from bisect import bisect_left, insort
 from builtins import sorted
+from collections import OrderedDict
 
 from leaf.core.constants import LeafConstants, LeafSettings
 from leaf.core.error import InvalidPackageNameException
@@ -9,6 +11,77 @@ from leaf.model.environment import Environment
 from leaf.model.package import PackageIdentifier
 
 
+class PackageCatalog(OrderedDict):
+
+    """
+    Map of manifests by PackageIdentifier, which also keeps the sorted versions of each package name.
+    Finding the latest version of a package or checking a version does not need to scan all packages
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.__versions = {}
+        OrderedDict.__init__(self, *args, **kwargs)
+
+    def __setitem__(self, pi, value):
+        if not isinstance(pi, PackageIdentifier):
+            raise ValueError()
+        if pi not in self:
+            insort(self.__versions.setdefault(pi.name, []), pi)
+        OrderedDict.__setitem__(self, pi, value)
+
+    def __delitem__(self, pi):
+        OrderedDict.__delitem__(self, pi)
+        self.__remove_version(pi)
+
+    def __remove_version(self, pi):
+        versions = self.__versions.get(pi.name)
+        if versions is not None:
+            index = bisect_left(versions, pi)
+            if index < len(versions) and versions[index] == pi:
+                del versions[index]
+            if len(versions) == 0:
+                del self.__versions[pi.name]
+
+    def pop(self, pi, *default):
+        if pi in self:
+            out = OrderedDict.__getitem__(self, pi)
+            del self[pi]
+            return out
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(pi)
+
+    def popitem(self, last=True):
+        pi, value = OrderedDict.popitem(self, last=last)
+        self.__remove_version(pi)
+        return pi, value
+
+    def setdefault(self, pi, default=None):
+        if pi not in self:
+            self[pi] = default
+        return OrderedDict.__getitem__(self, pi)
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.__versions.clear()
+
+    def names(self) -> list:
+        return sorted(self.__versions)
+
+    def versions(self, name: str) -> list:
+        """
+        Return the sorted PackageIdentifier list of the given package name
+        """
+        return list(self.__versions.get(name, ()))
+
+    def latest(self, name: str) -> PackageIdentifier:
+        """
+        Return the highest version of the given package name, None if the package is unknown
+        """
+        versions = self.__versions.get(name)
+        return versions[-1] if versions else None
+
+
 def check_leaf_min_version(mflist: list):
     out = None
     for mf in mflist:
@@ -36,20 +109,25 @@ def build_shell_command(*args, env=None):
     return [LeafSettings.DEFAULT_SHELL.value, "-c", shell_command]
 
 
-def execute_command(*args, cwd=None, env=None, print_stdout=False):
+def execute_command(*args, cwd=None, env=None, print_stdout=False, stdout=None):
     """
     Execute a process and returns the return code.
     The command is run in a leaf default shell (see settings) $SHELL -c
     and the env is set via multiple export/source commands to preserve variable overriding
+    If a stdout stream is given, the printed output is written to it instead of the standard output
     """
     # Builds args
     kwargs = {"stdout": subprocess.DEVNULL, "stderr": subprocess.STDOUT}
     if print_stdout:
-        kwargs["stdout"] = None
-        kwargs["stderr"] = None
+        kwargs["stdout"] = None if stdout is None else subprocess.PIPE
+        kwargs["stderr"] = None if stdout is None else subprocess.STDOUT
     if cwd is not None:
         kwargs["cwd"] = str(cwd)
     # Execute the command
+    if print_stdout and stdout is not None:
+        process = subprocess.run(build_shell_command(*args, env=env), **kwargs)
+        stdout.write(process.stdout.decode(errors="replace"))
+        return process.returncode
     return subprocess.call(build_shell_command(*args, env=env), **kwargs)
 
 
@@ -66,9 +144,12 @@ def find_latest_version(pi_or_name, pilist, ignore_unknown=False):
     """
     out = None
     piname = pi_or_name.name if isinstance(pi_or_name, PackageIdentifier) else str(pi_or_name)
-    for pi in [pi for pi in pilist if pi.name == piname]:
-        if out is None or pi > out:
-            out = pi
+    if isinstance(pilist, PackageCatalog):
+        out = pilist.latest(piname)
+    else:
+        for pi in [pi for pi in pilist if pi.name == piname]:
+            if out is None or pi > out:
+                out = pi
     if out is None and not ignore_unknown:
         raise InvalidPackageNameException(pi_or_name)
     return out
@@ -82,7 +163,7 @@ def find_manifest(pi, mfmap, ignore_unknown=False):
     if not isinstance(mfmap, dict):
         raise ValueError()
     if is_latest_package(pi):
-        pi = find_latest_version(pi, mfmap.keys(), ignore_unknown=True)
+        pi = find_latest_version(pi, mfmap, ignore_unknown=True)
     if pi in mfmap:
         return mfmap[pi]
     if not ignore_unknown:
@@ -103,6 +184,9 @@ def find_manifest_list(pilist, mfmap, ignore_unknown=False):
 
 
 def group_package_identifiers_by_name(pilist, pkgmap=None) -> dict:
+    if isinstance(pilist, PackageCatalog) and pkgmap is None:
+        # Versions are already grouped and sorted
+        return {name: pilist.versions(name) for name in pilist.names()}
     out = pkgmap if pkgmap is not None else {}
     for pi in pilist:
         if not isinstance(pi, PackageIdentifier):
@@ -119,6 +203,8 @@ def group_package_identifiers_by_name(pilist, pkgmap=None) -> dict:
 
 
 def keep_latest(pilist: list) -> list:
+    if isinstance(pilist, PackageCatalog):
+        return [pilist.latest(name) for name in pilist.names()]
     pkgmap = {}
     for pi in pilist:
         if pi.name not in pkgmap or pi > pkgmap[pi.name]:
@@ -22,7 +22,7 @@ from leaf.core.constants import JsonConstants, LeafFiles
 from leaf.core.download import url_resolve
 from leaf.core.error import InvalidPackageNameException, LeafException
 from leaf.core.jsonutils import JsonObject, jload, jloadfile, jloads
-from leaf.core.utils import Version
+from leaf.core.utils import Version, hash_select
 from leaf.model.environment import Environment, IEnvProvider
 from leaf.model.help import HelpTopic
 from leaf.model.settings import ScopeSetting
@@ -254,29 +254,45 @@ class LeafArtifact(Manifest):
     Represent a tar/xz or a single manifest.json file
     """
 
-    @staticmethod
-    def __find_manifest(tarfile):
-        for prefix in ("", "./"):
-            out = prefix + LeafFiles.MANIFEST
-            if out in tarfile.getnames():
-                return out
-        raise ValueError("Cannot find {file} in package".format(file=LeafFiles.MANIFEST))
+    __MANIFEST_NAMES = (LeafFiles.MANIFEST, "./" + LeafFiles.MANIFEST)
 
     def __init__(self, path):
         self.__path = path
+        self.__members = None
         with TarFile.open(str(self.__path), "r") as tarfile:
-            mf = LeafArtifact.__find_manifest(tarfile)
+            # Archives created by leaf store the manifest first, no need to scan the whole archive
+            mf = tarfile.next()
+            if mf is None or mf.name not in LeafArtifact.__MANIFEST_NAMES:
+                self.__members = tarfile.getmembers()
+                mf = self.__find_manifest(self.__members)
             Manifest.__init__(self, jload(io.TextIOWrapper(tarfile.extractfile(mf))))
 
+    @staticmethod
+    def __find_manifest(members: list):
+        for name in LeafArtifact.__MANIFEST_NAMES:
+            for ti in members:
+                if ti.name == name:
+                    return ti
+        raise ValueError("Cannot find {file} in package".format(file=LeafFiles.MANIFEST))
+
     @property
     def path(self):
         return self.__path
 
+    @property
+    def members(self) -> list:
+        """
+        Return the TarInfo list of the archive, which is scanned only once
+        """
+        if self.__members is None:
+            with TarFile.open(str(self.__path), "r") as tarfile:
+                self.__members = tarfile.getmembers()
+        return self.__members
+
     def get_total_size(self):
         out = 0
-        with TarFile.open(str(self.__path), "r") as tarfile:
-            for ti in tarfile.getmembers():
-                out += ti.size
+        for ti in self.members:
+            out += ti.size
         return out
 
 
@@ -303,6 +319,21 @@ class AvailablePackage(Manifest):
     def hashsum(self):
         return self.jsonget(JsonConstants.REMOTE_PACKAGE_HASH)
 
+    @property
+    def hashes(self):
+        """
+        All the hashes of the artifact, the legacy hash first then the additional ones
+        """
+        out = [self.hashsum] if self.hashsum is not None else []
+        return out + [h for h in self.jsonget(JsonConstants.REMOTE_PACKAGE_HASHES, default=[]) if h not in out]
+
+    @property
+    def best_hashsum(self):
+        """
+        The hash used to verify the artifact, with the fastest supported method
+        """
+        return hash_select(self.hashes)
+
     @property
     def subpath(self):
         return self.jsonget(JsonConstants.REMOTE_PACKAGE_FILE, mandatory=True)
@@ -344,8 +375,11 @@ class InstalledPackage(Manifest, IEnvProvider):
     Represent an installed package
     """
 
-    def __init__(self, mffile: Path, read_only=False):
-        Manifest.__init__(self, jloadfile(mffile))
+    def __init__(self, mffile: Path, read_only=False, json: dict = None):
+        """
+        If the manifest content is given, the manifest file is not read
+        """
+        Manifest.__init__(self, json if json is not None else jloadfile(mffile))
         IEnvProvider.__init__(self, "package {pi}".format(pi=self.identifier))
         self.__folder = mffile.parent
         self.__read_only = read_only
@@ -91,7 +91,7 @@ class StepExecutor:
 
         verbose = step.get(JsonConstants.STEP_EXEC_VERBOSE, False)
 
-        rc = execute_command(*command, cwd=self.__target_folder, env=env, print_stdout=verbose or self.__logger.isverbose())
+        rc = execute_command(*command, cwd=self.__target_folder, env=env, print_stdout=verbose or self.__logger.isverbose(), stdout=self.__logger.stdout)
         if rc != 0:
             self.__logger.print_verbose("Command '{command}' exited with {rc}".format(command=command_text, rc=rc))
             if step.get(JsonConstants.STEP_IGNORE_FAIL, False):
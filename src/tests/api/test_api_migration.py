@@ -2,6 +2,8 @@
 @author: Legato Tooling Team <letools@sierrawireless.com>
 """
 
+import os
+import time
 from collections import OrderedDict
 
 from leaf import __version__
@@ -107,3 +109,37 @@ class TestApiMigration(LeafTestCase):
         self.assertEqual("1.0", ws_config.json["profiles"]["foo"]["packages"]["test"])
         self.assertTrue(isinstance(ws_config.json["profiles"]["bar"]["packages"], OrderedDict))
         self.assertEqual("2.0", ws_config.json["profiles"]["bar"]["packages"]["test"])
+
+    def test_config_cache(self):
+        etcfile = self.test_folder / "etc.json"
+        userfile = self.test_folder / "user.json"
+        jwritefile(etcfile, {"env": {"FOO": "etc", "BAR": "etc"}})
+        jwritefile(userfile, {"env": {"FOO": "aaa"}})
+        # Recent changes are not trusted, timestamps may be too coarse
+        past = time.time() - 3600
+        for file in (etcfile, userfile):
+            os.utime(str(file), (past, past))
+
+        user_config = UserConfiguration(etcfile, userfile)
+        self.assertEqual(OrderedDict([("FOO", "aaa"), ("BAR", "etc")]), user_config._getenvmap())
+        # Models can be modified without altering the cache
+        user_config._getenvmap()["FOO"] = "foo"
+        self.assertEqual("aaa", UserConfiguration(etcfile, userfile)._getenvmap()["FOO"])
+        self.assertIsNot(UserConfiguration(etcfile, userfile).json, UserConfiguration(etcfile, userfile).json)
+
+        # Unchanged files are not read again
+        jwritefile(userfile, {"env": {"FOO": "bbb"}})
+        os.utime(str(userfile), (past, past))
+        self.assertEqual("aaa", UserConfiguration(etcfile, userfile)._getenvmap()["FOO"])
+
+        # Modified files are read again
+        os.utime(str(userfile), None)
+        self.assertEqual("bbb", UserConfiguration(etcfile, userfile)._getenvmap()["FOO"])
+
+        # Written layers are read again, even if their identity looks unchanged
+        os.utime(str(userfile), (past, past))
+        user_config = UserConfiguration(etcfile, userfile)
+        user_config._getenvmap()["FOO"] = "ccc"
+        user_config.write_layer(userfile, previous_layer=etcfile)
+        os.utime(str(userfile), (past, past))
+        self.assertEqual("ccc", UserConfiguration(etcfile, userfile)._getenvmap()["FOO"])
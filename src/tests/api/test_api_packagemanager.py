@@ -2,24 +2,38 @@
 @author: Legato Tooling Team <letools@sierrawireless.com>
 """
 
+import base64
+import io
+import marshal
 import os
 import random
+import re
+import shutil
 import socketserver
 import sys
+import tarfile
 import time
 import unittest
+from contextlib import redirect_stdout
 from datetime import datetime, timedelta
 from http.server import SimpleHTTPRequestHandler
+from multiprocessing import Event as MpEvent
 from multiprocessing import Process
+from threading import Event, Timer
 from time import sleep
 
 from leaf.api import PackageManager
-from leaf.core.error import (InvalidHashException, InvalidPackageNameException,
+from leaf.api.packages import _check_tar_member
+from leaf.core.constants import JsonConstants, LeafFiles, LeafSettings
+from leaf.core.download import download_and_stream_file, download_and_verify_file, download_file, download_file_segmented
+from leaf.core.error import (DownloadCancelledException, InvalidHashException, InvalidPackageNameException,
                              LeafException, LeafOutOfDateException,
                              NoEnabledRemoteException, NoRemoteException,
                              PrereqException)
+from leaf.core.jsonutils import jloadfile, jwritefile
+from leaf.core.lock import LockFile
 from leaf.core.settings import EnvVar
-from leaf.core.utils import NotEnoughSpaceException, is_folder_ignored
+from leaf.core.utils import NotEnoughSpaceException, hash_compute, hash_factory, hash_format, is_folder_ignored
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
 from leaf.model.package import (AvailablePackage, InstalledPackage,
@@ -60,6 +74,113 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
         self.pm.install_packages(PackageIdentifier.parse_list(pislist))
         self.check_content(self.pm.list_installed_packages(), pislist)
 
+    def test_installed_index(self):
+        pislist = ["version_1.0", "version_2.0"]
+        pilist = PackageIdentifier.parse_list(pislist)
+        self.pm.install_packages(pilist)
+        indexfile = self.pm.cache_folder / LeafFiles.CACHE_INSTALLED_INDEX_FILENAME
+        folder = self.pm.install_folder / "version_1.0"
+        mffile = folder / LeafFiles.MANIFEST
+
+        # Recent changes are not trusted, timestamps may be too coarse
+        past = time.time() - 3600
+
+        def age(*files):
+            for file in files:
+                os.utime(str(file), (past, past))
+
+        age(self.pm.install_folder, folder, mffile, self.pm.install_folder / "version_2.0", self.pm.install_folder / "version_2.0" / LeafFiles.MANIFEST)
+        self.check_content(self.pm.list_installed_packages(), pislist)
+        self.assertTrue(indexfile.exists())
+
+        # Unchanged folders are not read again, the size is kept to only change the content
+        mffile.write_text(mffile.read_text().replace('"TEST_VERSION": "1.0"', '"TEST_VERSION": "foo"'))
+        age(mffile)
+        self.assertEqual("1.0", self.pm.list_installed_packages()[pilist[0]].jsonpath(["env", "TEST_VERSION"]))
+
+        # Modified manifests are read again
+        mffile.touch()
+        self.assertEqual("foo", self.pm.list_installed_packages()[pilist[0]].jsonpath(["env", "TEST_VERSION"]))
+
+        # Removed packages are detected with the root folder modification time
+        shutil.rmtree(str(self.pm.install_folder / "version_2.0"))
+        self.check_content(self.pm.list_installed_packages(), pislist[:1])
+
+        # An invalid index is rebuilt
+        indexfile.write_text("foo")
+        self.check_content(self.pm.list_installed_packages(), pislist[:1])
+        self.assertEqual([str(self.pm.install_folder)], list(jloadfile(indexfile)))
+
+    def test_model_cache(self):
+        pi = PackageIdentifier.parse("version_1.0")
+        # Without model cache, manifests are read on each call
+        self.assertIsNot(self.pm.list_available_packages()[pi], self.pm.list_available_packages()[pi])
+
+        with self.pm.model_cache():
+            apmap = self.pm.list_available_packages()
+            self.assertIs(apmap[pi], self.pm.list_available_packages()[pi])
+            # Returned maps can be modified
+            del apmap[pi]
+            self.assertIn(pi, self.pm.list_available_packages())
+
+            self.assertEqual(0, len(self.pm.list_installed_packages()))
+            # Installing packages invalidates the cache
+            self.pm.install_packages([pi])
+            ip = self.pm.list_installed_packages()[pi]
+            self.assertIs(ip, self.pm.list_installed_packages()[pi])
+            self.pm.uninstall_packages([pi])
+            self.assertEqual(0, len(self.pm.list_installed_packages()))
+
+            # Refreshing remotes invalidates the cache
+            self.assertIsNot(apmap[PackageIdentifier.parse("version_2.0")], self.pm.list_available_packages(force_refresh=True)[PackageIdentifier.parse("version_2.0")])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Compiled indexes need ordered dicts")
+    def test_remote_compiled(self):
+        index_file = self.pm.remote_cache_folder / "default.json"
+        compiled_file = self.pm.remote_cache_folder / "default.marshal"
+        # Indexes are compiled when fetched, but a recent index is not trusted
+        self.assertTrue(compiled_file.exists())
+        with compiled_file.open("rb") as fp:
+            identity, content = marshal.load(fp)
+        self.assertIsNone(identity)
+        past = time.time() - 3600
+        os.utime(str(index_file), (past, past))
+        apcount = len(self.pm.list_available_packages())
+        # The compiled index only holds plain data, in the index order
+        with compiled_file.open("rb") as fp:
+            identity, content = marshal.load(fp)
+        self.assertIsNotNone(identity)
+        self.assertEqual(jloadfile(index_file), content)
+        self.assertEqual(list(jloadfile(index_file)[JsonConstants.REMOTE_PACKAGES]), list(content[JsonConstants.REMOTE_PACKAGES]))
+
+        # The compiled index is used while the index file is unchanged
+        stat = index_file.stat()
+        index_file.write_text(" " * stat.st_size)
+        os.utime(str(index_file), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(apcount, len(self.pm.list_available_packages()))
+
+        # A modified index is parsed again
+        index_file.touch()
+        self.assertFalse(self.pm.list_remotes()["default"].is_fetched)
+        self.assertFalse(compiled_file.exists())
+        self.pm.fetch_remotes()
+        self.assertTrue(compiled_file.exists())
+        self.assertEqual(apcount, len(self.pm.list_available_packages()))
+
+        # A compiled file which does not hold plain data is ignored
+        identity = marshal.loads(compiled_file.read_bytes())[0]
+        with compiled_file.open("wb") as fp:
+            marshal.dump([identity, {"packages": [compile("0", "<index>", "eval")]}], fp, 4)
+        self.assertEqual(apcount, len(self.pm.list_available_packages()))
+        self.assertEqual(jloadfile(index_file), marshal.loads(compiled_file.read_bytes())[1])
+
+        # The index is still used if the compiled file cannot be written
+        compiled_file.unlink()
+        compiled_file.mkdir()
+        self.assertEqual(apcount, len(self.pm.list_available_packages()))
+        self.assertTrue(index_file.exists())
+        self.assertTrue(self.pm.list_remotes()["default"].is_fetched)
+
     def test_enable_disable_remote(self):
         self.assertEqual(2, len(self.pm.list_remotes(True)))
         self.assertTrue(len(self.pm.list_available_packages()) > 0)
@@ -105,6 +226,36 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
             self.pm.create_remote("myremote", "", insecure=True)
         self.assertEqual(2, len(self.pm.list_remotes(True)))
 
+    def test_fetch_remotes_with_error(self):
+        self.pm.create_remote("broken", (self.volatile_folder / "missing.json").as_uri(), insecure=True)
+        self.pm.fetch_remotes(force_refresh=True)
+        remotes = self.pm.list_remotes(only_enabled=True)
+        self.assertEqual(["default", "other", "broken"], list(remotes.keys()))
+        self.assertTrue(remotes["default"].is_fetched)
+        self.assertTrue(remotes["other"].is_fetched)
+        self.assertFalse(remotes["broken"].is_fetched)
+
+    def test_install_workers(self):
+        pilist = PackageIdentifier.parse_list(["container-A_1.0", "env-A_1.0", "condition_1.0"])
+
+        def install(workers):
+            stdout = io.StringIO()
+            try:
+                LeafSettings.INSTALL_WORKERS.value = workers
+                with redirect_stdout(stdout):
+                    iplist = self.pm.install_packages(pilist)
+            finally:
+                LeafSettings.INSTALL_WORKERS.value = None
+            self.pm.uninstall_packages([ip.identifier for ip in iplist])
+            # Only keep installation messages, commands output is not captured in sequential mode
+            return [line for line in stdout.getvalue().splitlines() if re.match(r"(\[\d+/\d+\] Installing|Run )", line)], iplist
+
+        expected_output, expected_iplist = install(1)
+        output, iplist = install(4)
+        # Output is printed in install order
+        self.assertEqual(expected_output, output)
+        self.assertEqual([ip.identifier for ip in expected_iplist], [ip.identifier for ip in iplist])
+
     def test_container(self):
         self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
         self.check_content(self.pm.list_installed_packages(), ["container-A_1.0", "container-B_1.0", "container-C_1.0", "container-E_1.0"])
@@ -234,6 +385,313 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
         with self.assertRaises(InvalidHashException):
             self.pm.install_packages(PackageIdentifier.parse_list(["failure-badhash_1.0"]))
 
+    def test_download_failure_cleanup(self):
+        with self.assertRaises(InvalidHashException):
+            self.pm.install_packages(PackageIdentifier.parse_list(["compress-tar_1.0", "failure-badhash_1.0", "compress-xz_1.0"]))
+        self.check_content(self.pm.list_installed_packages(), [])
+        ap = self.pm.list_available_packages()[PackageIdentifier.parse("failure-badhash_1.0")]
+        self.assertFalse(self.pm.download_cache.get_file(ap.filename, ap.hashsum).exists())
+
+    def test_download_cache(self):
+        pilist = PackageIdentifier.parse_list(["compress-tar_1.0", "compress-xz_1.0", "compress-gz_1.0"])
+        apmap = self.pm.list_available_packages()
+        files = [self.pm.download_cache.get_file(apmap[pi].filename, apmap[pi].hashsum) for pi in pilist]
+        for pi, file in zip(pilist, files):
+            self.pm.install_packages([pi])
+            # Cached files are addressed by their hash
+            self.assertEqual(hash_compute(file), "sha384:" + file.name)
+        self.assertEqual(files, self.pm.download_cache.list_files())
+        # The cache size is known from the ledger
+        self.assertEqual(sum(f.stat().st_size for f in files), self.pm.download_cache.get_total_size())
+
+        # Reinstalling a package marks its artifact as recently used
+        self.pm.uninstall_packages(pilist[:1])
+        self.pm.install_packages(pilist[:1])
+        self.assertEqual(files[1:] + files[:1], self.pm.download_cache.list_files())
+
+        # Only the coldest artifacts are evicted, with their lock file
+        locks_folder = self.pm.cache_folder / "locks"
+        lockfiles = [locks_folder / (f.relative_to(self.pm.download_cache.folder).as_posix().replace("/", "_") + ".lock") for f in files]
+        self.assertTrue(all(lf.exists() for lf in lockfiles))
+        max_size = files[0].stat().st_size + files[2].stat().st_size
+        self.assertEqual(files[1:2], self.pm.download_cache.evict(max_size))
+        self.assertEqual([files[2], files[0]], self.pm.download_cache.list_files())
+        self.assertEqual([True, False, True], [lf.exists() for lf in lockfiles])
+
+        # Artifacts locked by a download are kept
+        ready = MpEvent()
+        process = Process(target=hold_lock, args=(lockfiles[2], ready, 2))
+        process.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            self.assertEqual(files[:1], self.pm.download_cache.evict(0))
+        finally:
+            process.join()
+        self.assertEqual(files[2:], self.pm.download_cache.list_files())
+        self.assertEqual([False, False, True], [lf.exists() for lf in lockfiles])
+
+        # Cleaning the cache removes all the lock files
+        self.pm.download_cache.clean()
+        self.assertFalse(locks_folder.exists())
+        self.assertEqual(0, self.pm.download_cache.get_total_size())
+
+    def test_download_cache_verify(self):
+        pilist = PackageIdentifier.parse_list(["compress-tar_1.0", "compress-xz_1.0"])
+        self.pm.install_packages(pilist)
+        apmap = self.pm.list_available_packages()
+        files = [self.pm.download_cache.get_file(apmap[pi].filename, apmap[pi].hashsum) for pi in pilist]
+        ledger_file = self.pm.cache_folder / "files.ledger"
+        self.assertTrue(ledger_file.exists())
+
+        # Corrupt an artifact, the cached file may be a hard link to the remote artifact
+        content = files[0].read_bytes()
+        files[0].unlink()
+        files[0].write_bytes(content + b"foo")
+        self.assertEqual(files[:1], self.pm.download_cache.verify())
+        self.assertFalse(files[0].exists())
+        self.assertEqual(files[1:], self.pm.download_cache.list_files())
+        self.assertEqual(files[1].stat().st_size, self.pm.download_cache.get_total_size())
+
+        # The ledger is rebuilt if missing, and saved
+        ledger_file.unlink()
+        self.assertEqual(files[1:], self.pm.download_cache.list_files())
+        self.assertEqual(files[1].stat().st_size, self.pm.download_cache.get_total_size())
+        self.assertTrue(ledger_file.exists())
+
+        # A ledger written by a previous version is rebuilt too
+        jwritefile(ledger_file, {"totalSize": 0, "files": {}})
+        self.assertEqual(files[1].stat().st_size, self.pm.download_cache.get_total_size())
+
+    def test_download_cache_trusted(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages()[pi]
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        try:
+            # The cached file will be modified, it must not be a hard link to the remote artifact
+            LeafSettings.DOWNLOAD_LOCAL_COPY.value = 1
+            self.pm.install_packages([pi])
+        finally:
+            LeafSettings.DOWNLOAD_LOCAL_COPY.value = None
+        # Recent changes are not trusted, timestamps may be too coarse
+        self.assertFalse(self.pm.download_cache.is_verified(file, ap.hashsum))
+        past = time.time() - 3600
+        os.utime(str(file), (past, past))
+        self.pm.uninstall_packages([pi])
+        self.pm.install_packages([pi])
+        self.assertTrue(self.pm.download_cache.is_verified(file, ap.hashsum))
+        self.assertFalse(self.pm.download_cache.is_verified(file, "sha384:" + "0" * 96))
+
+        # Corrupt the artifact without changing its size nor its modification time
+        stat = file.stat()
+        content = bytearray(file.read_bytes())
+        content[-1] ^= 0xFF
+        file.write_bytes(bytes(content))
+        os.utime(str(file), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertTrue(self.pm.download_cache.is_verified(file, ap.hashsum))
+
+        # The hash is checked anyway if forced
+        self.pm.uninstall_packages([pi])
+        try:
+            LeafSettings.CACHE_VERIFY.value = 1
+            self.pm.install_packages([pi])
+        finally:
+            LeafSettings.CACHE_VERIFY.value = None
+        self.assertEqual(ap.hashsum, hash_compute(file))
+
+        # A modified file is not trusted anymore
+        os.utime(str(file), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertFalse(self.pm.download_cache.is_verified(file, ap.hashsum))
+
+    def test_install_hash_methods(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        index = self.repository_folder / "index-hashes.json"
+        index_content = jloadfile(self.repository_folder / "index.json")
+        node = next(n for n in index_content[JsonConstants.REMOTE_PACKAGES] if n[JsonConstants.INFO][JsonConstants.INFO_NAME] == pi.name)
+        blake2b = hash_compute(self.repository_folder / node[JsonConstants.REMOTE_PACKAGE_FILE], method="blake2b")
+        node[JsonConstants.REMOTE_PACKAGE_HASHES] = [blake2b]
+        jwritefile(index, index_content)
+        self.pm.delete_remote("default")
+        self.pm.create_remote("default", index.as_uri(), insecure=True)
+        ap = self.pm.list_available_packages(force_refresh=True)[pi]
+        self.assertEqual(blake2b, ap.best_hashsum)
+
+        # The artifact is verified with the fastest hash, and still stored by its legacy hash
+        self.pm.install_packages([pi])
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        self.assertTrue(self.pm.download_cache.is_verified(file, blake2b))
+
+        # An invalid additional hash is detected
+        self.pm.uninstall_packages([pi])
+        file.unlink()
+        node[JsonConstants.REMOTE_PACKAGE_HASHES] = ["blake2b:" + "0" * 128]
+        jwritefile(index, index_content)
+        self.pm.list_available_packages(force_refresh=True)
+        with self.assertRaises(InvalidHashException):
+            self.pm.install_packages([pi])
+
+    def test_download_partial_file(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages()[pi]
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        partfile = file.parent / (file.name + ".part")
+        # Simulate an interrupted download
+        file.parent.mkdir(parents=True)
+        with (self.repository_folder / ap.filename).open("rb") as src, partfile.open("wb") as fp:
+            fp.write(src.read(100))
+        self.assertEqual([], self.pm.download_cache.list_files())
+
+        self.pm.install_packages([pi])
+        self.assertFalse(partfile.exists())
+        self.assertEqual(ap.hashsum, hash_compute(file))
+
+    def test_prune_partial_files(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages()[pi]
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        partfile = file.parent / (file.name + ".part")
+        journalfile = file.parent / (file.name + ".journal")
+        file.parent.mkdir(parents=True)
+        for f in (partfile, journalfile):
+            f.write_text("foo")
+
+        # Recent interrupted downloads may be resumed
+        self.assertEqual([], self.pm.download_cache.prune_partial_files())
+        old = time.time() - 8 * 24 * 3600
+        for f in (partfile, journalfile):
+            os.utime(str(f), (old, old))
+
+        # Downloads in progress are kept
+        lockfile = self.pm.cache_folder / "locks" / (file.relative_to(self.pm.download_cache.folder).as_posix().replace("/", "_") + ".lock")
+        lockfile.parent.mkdir(parents=True, exist_ok=True)
+        ready = MpEvent()
+        process = Process(target=hold_lock, args=(lockfile, ready, 2))
+        process.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            self.assertEqual([], self.pm.download_cache.prune_partial_files())
+        finally:
+            process.join()
+
+        self.assertEqual(sorted([partfile, journalfile]), sorted(self.pm.download_cache.prune_partial_files()))
+        self.assertFalse(partfile.exists())
+        self.assertFalse(journalfile.exists())
+        # Nothing is left for the artifact, its lock file is removed
+        self.assertFalse(lockfile.exists())
+
+    def test_download_lock(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages()[pi]
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        lockfile = self.pm.cache_folder / "locks" / (file.relative_to(self.pm.download_cache.folder).as_posix().replace("/", "_") + ".lock")
+        lockfile.parent.mkdir(parents=True, exist_ok=True)
+
+        # Another process is downloading the artifact
+        ready = MpEvent()
+        process = Process(target=hold_lock, args=(lockfile, ready, 2))
+        process.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            start = time.time()
+            self.pm.install_packages([pi])
+            self.assertGreater(time.time() - start, 1)
+        finally:
+            process.join()
+        self.check_content(self.pm.list_installed_packages(), ["compress-xz_1.0"])
+
+    def test_download_local_link(self):
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages()[pi]
+        file = self.pm.download_cache.get_file(ap.filename, ap.hashsum)
+        source = self.repository_folder / ap.filename
+        local = ap.url.startswith("file:")
+        try:
+            LeafSettings.DOWNLOAD_LOCAL_COPY.value = 1
+            self.pm.install_packages([pi])
+            self.assertFalse(os.path.samefile(str(file), str(source)))
+        finally:
+            LeafSettings.DOWNLOAD_LOCAL_COPY.value = None
+
+        # Artifacts from local remotes are not copied, and their times are not modified
+        self.pm.uninstall_packages([pi])
+        self.pm.download_cache.clean()
+        # The access time is set in the future so that reading the file does not update it (relatime)
+        atime = int(time.time() + 3600) * 10 ** 9
+        os.utime(str(source), ns=(atime, source.stat().st_mtime_ns))
+        self.pm.install_packages([pi])
+        self.assertEqual(local, os.path.samefile(str(file), str(source)))
+        self.assertEqual(atime, source.stat().st_atime_ns)
+        self.assertEqual(ap.hashsum, hash_compute(file))
+        self.check_content(self.pm.list_installed_packages(), ["compress-xz_1.0"])
+
+    def test_download_local_link_partial(self):
+        source = self.repository_folder / "compress-xz_1.0.leaf"
+        hashstr = hash_compute(source)
+        output = self.volatile_folder / source.name
+        partfile = self.volatile_folder / (source.name + ".part")
+
+        def interrupt(worked, total):
+            if worked == total:
+                raise KeyboardInterrupt()
+
+        # An interrupted download does not leave a partial file linked to the local artifact
+        with self.assertRaises(KeyboardInterrupt):
+            download_and_verify_file(source.as_uri(), output, hashstr=hashstr, progress=interrupt)
+        self.assertFalse(partfile.exists())
+        self.assertFalse(output.exists())
+
+        # A linked partial file is never written into by other downloads
+        for download in (
+            lambda: download_and_verify_file("http://localhost:1/" + source.name, output, hashstr=hashstr, retry=0),
+            lambda: download_and_stream_file("http://localhost:1/" + source.name, output, lambda stream: None, hashstr=hashstr),
+        ):
+            os.link(str(source), str(partfile))
+            with self.assertRaises(OSError):
+                download()
+            self.assertEqual(hashstr, hash_compute(source))
+            if partfile.exists():
+                partfile.unlink()
+
+    def test_download_generic_scheme(self):
+        source = self.repository_folder / "compress-xz_1.0.leaf"
+        content = source.read_bytes()
+        url = "data:application/octet-stream;base64," + base64.b64encode(content).decode()
+        output = self.volatile_folder / "data.leaf"
+        progress = []
+        hasher = download_file(url, output, progress=lambda worked, total: progress.append(worked), hasher_factory=hash_factory(hash_compute(source)))
+        self.assertEqual(content, output.read_bytes())
+        self.assertEqual(hash_compute(source), hash_format(hasher))
+        # The content is written by chunks, with progress
+        self.assertEqual(len(content), progress[-1])
+        self.assertEqual(sorted(progress), progress)
+
+    def test_download_hash(self):
+        ap = self.pm.list_available_packages()[PackageIdentifier.parse("compress-xz_1.0")]
+        output = self.volatile_folder / ap.filename
+        # Simulate a partial download
+        with (self.repository_folder / ap.filename).open("rb") as src, output.open("wb") as fp:
+            fp.write(src.read(100))
+        hasher = download_file(ap.url, output, hasher_factory=hash_factory(ap.hashsum))
+        self.assertEqual(ap.hashsum, hash_format(hasher))
+        self.assertEqual(ap.hashsum, hash_compute(output))
+
+    def test_install_from_mirror(self):
+        mirror_folder = self.volatile_folder / "mirror"
+        mirror_folder.mkdir()
+        shutil.copy(str(self.repository_folder / "index.json"), str(mirror_folder / "index.json"))
+        # The mirror has the highest priority but does not host the artifacts
+        self.pm.create_remote("mirror", (mirror_folder / "index.json").as_uri(), insecure=True, priority=1)
+        pi = PackageIdentifier.parse("compress-xz_1.0")
+        ap = self.pm.list_available_packages(force_refresh=True)[pi]
+        self.assertEqual("mirror", ap.best_candidate.remote.alias)
+
+        self.pm.install_packages([pi])
+        self.check_content(self.pm.list_installed_packages(), ["compress-xz_1.0"])
+        stats = self.pm.read_remote_stats()
+        self.assertIn("lastFailure", stats["mirror"])
+        self.assertIn("throughput", stats["default"])
+        # The failing mirror is now tried last
+        self.assertEqual(["default", "mirror"], [c.remote.alias for c in self.pm.sort_candidates(ap.candidates, size=ap.size)])
+
     def test_outdated_leaf_version(self):
         with self.assertRaises(LeafOutOfDateException):
             self.pm.install_packages(PackageIdentifier.parse_list(["failure-minver_1.0"]))
@@ -333,7 +791,11 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
         self.assertEqual(2, len(get_lines(self.install_folder / "prereq-A_0.1-fail" / "sync.log")))
 
     def test_prereq(self):
-        self.pm.install_packages(PackageIdentifier.parse_list(["pkg-with-prereq_1.0"]))
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            self.pm.install_packages(PackageIdentifier.parse_list(["pkg-with-prereq_1.0"]))
+        # The progress of prereq downloads is displayed
+        self.assertIn("Downloading prereq-A_1.0.leaf", stdout.getvalue())
 
         self.check_content(self.pm.list_installed_packages(), ["pkg-with-prereq_1.0", "prereq-A_1.0", "prereq-B_1.0"])
 
@@ -530,11 +992,57 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
             testfunc(file.stat().st_size, la.get_total_size())
 
 
+class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
+
+    """
+    Simple http handler with support of single byte range requests, and If-Range with dates
+    """
+
+    def send_head(self):
+        self.range_length = None
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+        last_modified = self.date_time_string(int(os.path.getmtime(path)))
+        if self.headers.get("If-Range", last_modified) != last_modified:
+            # The file has changed, send it entirely
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.range_length = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.range_length is None:
+            super().copyfile(source, outputfile)
+        else:
+            outputfile.write(source.read(self.range_length))
+
+
+def hold_lock(lockfile, ready, duration):
+    with LockFile(lockfile).acquire():
+        ready.set()
+        sleep(duration)
+
+
 def start_http_server(folder):
     print("Start http server for {folder} on port {port}".format(folder=folder, port=HTTP_PORT), file=sys.stderr)
     os.chdir(str(folder))
     socketserver.TCPServer.allow_reuse_address = True
-    httpd = socketserver.TCPServer(("", HTTP_PORT.as_int()), SimpleHTTPRequestHandler)
+    httpd = socketserver.TCPServer(("", HTTP_PORT.as_int()), RangeHTTPRequestHandler)
     httpd.serve_forever()
 
 
@@ -561,6 +1069,179 @@ class TestApiPackageManagerHttp(TestApiPackageManager):
     def remote_url1(self):
         return "http://localhost:{port}/index.json".format(port=HTTP_PORT)
 
+    def test_remote_not_modified(self):
+        index_file = self.pm.remote_cache_folder / "default.json"
+        self.assertTrue((self.pm.remote_cache_folder / "default.validators").exists())
+
+        # Alter the cached index, it should not be downloaded again since it has not been modified
+        with index_file.open("a") as fp:
+            fp.write(" ")
+        content = index_file.read_text()
+        yesterday = (datetime.now() - timedelta(hours=24)).timestamp()
+        os.utime(str(index_file), (yesterday, yesterday))
+        self.pm.fetch_remotes(force_refresh=True)
+        self.assertEqual(content, index_file.read_text())
+        self.assertFalse(self.pm.is_file_outdated(index_file))
+        self.assertTrue(self.pm.list_remotes()["default"].is_fetched)
+
+        # Without validators, the index is downloaded again
+        (self.pm.remote_cache_folder / "default.validators").unlink()
+        self.pm.fetch_remotes(force_refresh=True)
+        self.assertNotEqual(content, index_file.read_text())
+        self.assertTrue((self.pm.remote_cache_folder / "default.validators").exists())
+
+    def test_install_stream(self):
+        try:
+            LeafSettings.DOWNLOAD_STREAM.value = 1
+            pislist = ["compress-bz2_1.0", "compress-gz_1.0", "compress-tar_1.0", "compress-xz_1.0"]
+            self.pm.install_packages(PackageIdentifier.parse_list(pislist))
+            self.check_content(self.pm.list_installed_packages(), pislist)
+            self.assertFalse((self.install_folder / ".leaf-staging").exists())
+
+            # Content extracted while downloading must not be installed if the hash differs
+            with self.assertRaises(InvalidHashException):
+                self.pm.install_packages(PackageIdentifier.parse_list(["failure-badhash_1.0"]))
+            self.check_content(self.pm.list_installed_packages(), pislist)
+            self.assertFalse((self.install_folder / ".leaf-staging").exists())
+
+            # The extracted size is checked before extracting while downloading
+            ap = self.pm.list_available_packages()[PackageIdentifier.parse("failure-large-extracted_1.0")]
+            with self.assertRaises(NotEnoughSpaceException):
+                self.pm.install_packages([ap.identifier])
+            self.assertFalse(self.pm.download_cache.get_file(ap.filename, ap.best_hashsum).exists())
+            self.assertFalse((self.install_folder / ".leaf-staging").exists())
+        finally:
+            LeafSettings.DOWNLOAD_STREAM.value = None
+
+    def test_install_stream_unsafe(self):
+        ap = self.pm.list_available_packages()[PackageIdentifier.parse("failure-badhash_1.0")]
+        artifact = self.repository_folder / ap.filename
+        backup = artifact.read_bytes()
+        evil = self.install_folder / "evil.txt"
+
+        def member(name: str, linkname: str = None):
+            out = tarfile.TarInfo(name)
+            if linkname is not None:
+                out.type = tarfile.SYMTYPE
+                out.linkname = linkname
+            return out
+
+        # Tampered artifacts with members outside the staging folder
+        for members in ([member("../../evil.txt")], [member("link", linkname="../.."), member("link/evil.txt")], [member(str(evil))]):
+            # Members outside the folder are refused without extracting them
+            with self.assertRaises(LeafException):
+                for m in members:
+                    _check_tar_member(m)
+            with tarfile.open(str(artifact), "w") as tf:
+                for m in members:
+                    tf.addfile(m, io.BytesIO() if m.isfile() else None)
+            try:
+                LeafSettings.DOWNLOAD_STREAM.value = 1
+                with self.assertRaises(InvalidHashException):
+                    self.pm.install_packages([ap.identifier])
+            finally:
+                LeafSettings.DOWNLOAD_STREAM.value = None
+                artifact.write_bytes(backup)
+            self.assertFalse(evil.exists())
+            self.assertFalse((self.install_folder / ".leaf-staging").exists())
+        # Members inside the folder are accepted
+        for m in (member("foo/../bar"), member("foo/link", linkname="../bar")):
+            self.assertIs(m, _check_tar_member(m))
+
+    def test_download_segmented(self):
+        ap = self.pm.list_available_packages()[PackageIdentifier.parse("compress-xz_1.0")]
+        output = self.volatile_folder / ap.filename
+        download_file_segmented([ap.url, ap.url.replace("localhost", "127.0.0.1")], output, ap.size, 3)
+        self.assertEqual(ap.hashsum, hash_compute(output))
+
+        # Ranges of an unreachable mirror are downloaded from the other one
+        output.unlink()
+        download_file_segmented([ap.url, "http://localhost:1/" + ap.filename], output, ap.size, 3, retry=0)
+        self.assertEqual(ap.hashsum, hash_compute(output))
+
+    def test_download_cancel_retry(self):
+        # Retries of an unreachable url stop as soon as the download is cancelled
+        cancel = Event()
+        Timer(0.5, cancel.set).start()
+        start = time.time()
+        with self.assertRaises(DownloadCancelledException):
+            download_file("http://localhost:1/foo.leaf", self.volatile_folder / "foo.leaf", cancel=cancel, retry=10)
+        self.assertLess(time.time() - start, 5)
+
+    def test_download_segmented_resume(self):
+        source = self.repository_folder / "large.bin"
+        source.write_bytes(os.urandom(17 * 1024 * 1024))
+        url = "http://localhost:{port}/large.bin".format(port=HTTP_PORT)
+        output = self.volatile_folder / "large.bin"
+        partfile = self.volatile_folder / "large.bin.part"
+        # A partial file of a simple download is resumed, it is not truncated by a segmented download
+        cancel = Event()
+
+        def interrupt(worked, total):
+            if worked > 5 * 1024 * 1024:
+                cancel.set()
+
+        with self.assertRaises(DownloadCancelledException):
+            download_file(url, partfile, progress=interrupt, cancel=cancel)
+        progress = []
+        try:
+            LeafSettings.DOWNLOAD_SEGMENTS.value = 4
+            download_and_verify_file(
+                url, output, hashstr=hash_compute(source), size=source.stat().st_size, progress=lambda worked, total: progress.append(worked)
+            )
+        finally:
+            LeafSettings.DOWNLOAD_SEGMENTS.value = None
+        self.assertEqual(source.read_bytes(), output.read_bytes())
+        self.assertFalse(partfile.exists())
+        # Only the verified chunks of the partial file are kept
+        self.assertGreaterEqual(min(progress), 4 * 1024 * 1024)
+
+    def test_download_journal(self):
+        source = self.repository_folder / "large.bin"
+        source.write_bytes(os.urandom(9 * 1024 * 1024))
+        url = "http://localhost:{port}/large.bin".format(port=HTTP_PORT)
+        output = self.volatile_folder / "large.bin"
+        journal = self.volatile_folder / "large.bin.journal"
+
+        def interrupt():
+            cancel = Event()
+
+            def progress(worked, total):
+                if worked > 5 * 1024 * 1024:
+                    cancel.set()
+
+            with self.assertRaises(DownloadCancelledException):
+                download_file(url, output, progress=progress, cancel=cancel)
+            self.assertTrue(journal.exists())
+
+        # Only the corrupted chunk is fetched again
+        interrupt()
+        with output.open("r+b") as fp:
+            fp.write(b"corrupted")
+        download_file(url, output)
+        self.assertEqual(source.read_bytes(), output.read_bytes())
+        self.assertFalse(journal.exists())
+
+        # Data after the last recorded chunk is not trusted
+        output.unlink()
+        interrupt()
+        with output.open("r+b") as fp:
+            fp.seek(5 * 1024 * 1024)
+            fp.write(b"corrupted")
+        hasher = download_file(url, output, hasher_factory=hash_factory(hash_compute(source)))
+        self.assertEqual(source.read_bytes(), output.read_bytes())
+        self.assertEqual(hash_compute(source), hash_format(hasher))
+
+        # The partial file is not used if the remote file changed
+        output.unlink()
+        interrupt()
+        source.write_bytes(os.urandom(9 * 1024 * 1024))
+        mtime = source.stat().st_mtime + 10
+        os.utime(str(source), (mtime, mtime))
+        download_file(url, output)
+        self.assertEqual(source.read_bytes(), output.read_bytes())
+        self.assertFalse(journal.exists())
+
     @property
     def remote_url2(self):
         return "http://localhost:{port}/index2.json".format(port=HTTP_PORT)
@@ -4,15 +4,18 @@
 
 import json
 import os
+import shutil
+import unittest
+from tarfile import TarFile
 
 from jsonschema.exceptions import ValidationError
 
 from leaf.api import RelengManager
-from leaf.core.constants import JsonConstants, LeafFiles
+from leaf.core.constants import JsonConstants, LeafFiles, LeafSettings
 from leaf.core.error import LeafException
 from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.core.utils import hash_compute
-from leaf.model.package import AvailablePackage
+from leaf.model.package import AvailablePackage, LeafArtifact
 from tests.testutils import TEST_REMOTE_PACKAGE_SOURCE, LeafTestCaseWithRepo, check_mime
 
 
@@ -29,6 +32,14 @@ class TestApiRelengManager(LeafTestCaseWithRepo):
             for args, mime in ((None, "x-tar"), (("."), "x-tar"), (("-z", "."), "gzip"), (("-j", "."), "x-bzip2"), (("-J", "."), "x-xz"), (("-a", "."), mime)):
                 self.rm.create_package(folder, output_file, tar_extra_args=args)
                 check_mime(output_file, mime)
+                # Manifest is stored first, and only once
+                with TarFile.open(str(output_file)) as tf:
+                    names = tf.getnames()
+                self.assertEqual("./" + LeafFiles.MANIFEST, names[0])
+                self.assertEqual(1, names.count("./" + LeafFiles.MANIFEST))
+                la = LeafArtifact(output_file)
+                self.assertEqual("install_1.0", str(la.identifier))
+                self.assertEqual(sum(ti.size for ti in la.members), la.get_total_size())
 
         check_all_compressions(".bin", "x-tar")
         check_all_compressions(".tar", "x-tar")
@@ -37,6 +48,22 @@ class TestApiRelengManager(LeafTestCaseWithRepo):
         check_all_compressions(".tar.bz2", "x-bzip2")
         check_all_compressions(".tar.xz", "x-xz")
 
+    @unittest.skipIf(shutil.which("bsdtar") is None, "bsdtar is not installed")
+    def test_package_bsdtar(self):
+        folder = TEST_REMOTE_PACKAGE_SOURCE / "install_1.0"
+        output_file = self.workspace_folder / "myPackage.leaf"
+        try:
+            LeafSettings.CUSTOM_TAR.value = "bsdtar"
+            self.rm.create_package(folder, output_file, tar_extra_args=["-z", "."])
+        finally:
+            LeafSettings.CUSTOM_TAR.value = None
+        check_mime(output_file, "gzip")
+        with TarFile.open(str(output_file)) as tf:
+            names = tf.getnames()
+        self.assertEqual("./" + LeafFiles.MANIFEST, names[0])
+        self.assertEqual(1, names.count("./" + LeafFiles.MANIFEST))
+        self.assertIn("./folder/data2", names)
+
     def test_external_info_file(self):
         folder = TEST_REMOTE_PACKAGE_SOURCE / "install_1.0"
         artifact = self.workspace_folder / "myPackage.leaf"
@@ -194,6 +221,38 @@ class TestApiRelengManager(LeafTestCaseWithRepo):
         index_content = jloadfile(index)
         self.assertEqual(11, len(index_content[JsonConstants.REMOTE_PACKAGES]))
 
+    def test_index_hash_workers(self):
+        artifacts = []
+        for pis in ("condition_1.0", "condition-A_1.0", "condition-B_1.0", "condition-C_1.0"):
+            artifacts.append(self.workspace_folder / (pis + ".leaf"))
+            self.rm.create_package(TEST_REMOTE_PACKAGE_SOURCE / pis, artifacts[-1], store_extenal_info=False)
+
+        packages = []
+        for workers in (1, 4):
+            index = self.workspace_folder / "index{0}.json".format(workers)
+            try:
+                LeafSettings.BUILD_WORKERS.value = workers
+                self.rm.generate_index(index, artifacts, use_external_info=False)
+            finally:
+                LeafSettings.BUILD_WORKERS.value = None
+            packages.append(jloadfile(index)[JsonConstants.REMOTE_PACKAGES])
+        # Hashes computed concurrently are the same, in the same order
+        self.assertEqual([hash_compute(a) for a in artifacts], [p[JsonConstants.REMOTE_PACKAGE_HASH] for p in packages[1]])
+        self.assertEqual(packages[0], packages[1])
+
+    def test_index_hash_methods(self):
+        artifacts = []
+        for pis, info in (("condition_1.0", True), ("condition-A_1.0", False)):
+            artifacts.append(self.workspace_folder / (pis + ".leaf"))
+            self.rm.create_package(TEST_REMOTE_PACKAGE_SOURCE / pis, artifacts[-1], store_extenal_info=info, hash_methods=["blake2b"])
+        index = self.workspace_folder / "index.json"
+        self.rm.generate_index(index, artifacts, hash_methods=["blake2b", "sha384"])
+        for artifact, node in zip(artifacts, jloadfile(index)[JsonConstants.REMOTE_PACKAGES]):
+            # The legacy hash is kept for older clients
+            self.assertEqual(hash_compute(artifact), node[JsonConstants.REMOTE_PACKAGE_HASH])
+            self.assertEqual([hash_compute(artifact, method="blake2b")], node[JsonConstants.REMOTE_PACKAGE_HASHES])
+            self.assertEqual(node[JsonConstants.REMOTE_PACKAGE_HASHES][0], AvailablePackage(node).best_hashsum)
+
     def test_index_same_artifact_different_hash(self):
         (self.workspace_folder / "a").mkdir(parents=True, exist_ok=True)
         (self.workspace_folder / "b").mkdir(parents=True, exist_ok=True)
@@ -211,6 +211,15 @@ class TestCliPackageManager(LeafTestCaseWithCli):
         self.leaf_exec(["package", "upgrade"], "--clean")
         self.check_installed_packages(["upgrade_1.0", "upgrade_2.0"])
 
+    def test_cache(self):
+        self.leaf_exec(["package", "install"], "container-A_1.0")
+        self.leaf_exec("cache")
+        self.leaf_exec(("cache", "stats"))
+        self.leaf_exec(("cache", "verify"))
+        self.leaf_exec(("cache", "prune"), "--max-size", "0")
+        self.leaf_exec(("cache", "prune"), "--all")
+        self.leaf_exec(("cache", "stats"))
+
     def test_free_space_issue(self):
         self.leaf_exec(["package", "install"], "failure-large-ap_1.0", expected_rc=2)
         self.leaf_exec(["package", "install"], "failure-large-extracted_1.0", expected_rc=2)
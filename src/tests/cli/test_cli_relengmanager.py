@@ -44,6 +44,13 @@ class TestCliRelengManager(LeafTestCaseWithCli):
 
         self.leaf_exec(("build", "pack"), "--no-info", "--output", output_file, "--input", folder, expected_rc=2)
 
+        output_file.unlink()
+        info_file.unlink()
+        self.leaf_exec(("build", "pack"), "--hash", "blake2b", "--output", output_file, "--input", folder)
+        info = jloadfile(info_file)
+        self.assertEqual(hash_compute(output_file), info[JsonConstants.REMOTE_PACKAGE_HASH])
+        self.assertEqual([hash_compute(output_file, method="blake2b")], info[JsonConstants.REMOTE_PACKAGE_HASHES])
+
     def test_manifest_generation(self):
         mffile = self.workspace_folder / LeafFiles.MANIFEST
 
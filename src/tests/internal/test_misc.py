@@ -2,15 +2,21 @@
 @author: Legato Tooling Team <letools@sierrawireless.com>
 """
 
+import os
+import time
 from pathlib import Path
 from random import shuffle
 from tempfile import mktemp
+from threading import Event, Thread
 
 from leaf.core.constants import LeafFiles
+from leaf.core.download import DownloadProgress, get_http_session
 from leaf.core.error import LeafException
 from leaf.core.jsonutils import JsonObject, jloadfile, jwritefile
 from leaf.core.lock import LockFile
-from leaf.model.modelutils import keep_latest
+from leaf.core.logger import TextLogger
+from leaf.core.utils import fs_atomic_write, fs_get_identity, fs_is_racy, hash_check, hash_compute, hash_parse, hash_select
+from leaf.model.modelutils import PackageCatalog, find_latest_version, find_manifest, group_package_identifiers_by_name, keep_latest
 from leaf.model.package import AvailablePackage, InstalledPackage, PackageIdentifier
 from leaf.model.remote import Remote
 from leaf.model.steps import VariableResolver
@@ -64,6 +70,33 @@ class TestMisc(LeafTestCase):
             latest_pilist = keep_latest([b10, a20, a10, b11, b21, b20, a21, a11])
             self.assertEqual(latest_pilist, [a21, b21])
 
+    def test_package_catalog(self):
+        pilist = PackageIdentifier.parse_list(["a_1.0", "b_1.0", "a_2.0", "a_1.10", "c_1.0"])
+        catalog = PackageCatalog((pi, str(pi)) for pi in pilist)
+        self.assertEqual(pilist, list(catalog))
+        self.assertEqual(["a", "b", "c"], catalog.names())
+        self.assertEqual(PackageIdentifier.parse_list(["a_1.0", "a_1.10", "a_2.0"]), catalog.versions("a"))
+        self.assertEqual(PackageIdentifier.parse("a_2.0"), catalog.latest("a"))
+        self.assertIsNone(catalog.latest("d"))
+
+        # Helpers give the same results with a catalog or a dict
+        for mfmap in (catalog, dict(catalog)):
+            self.assertEqual(PackageIdentifier.parse("a_2.0"), find_latest_version("a", mfmap))
+            self.assertEqual("a_2.0", find_manifest(PackageIdentifier.parse("a_latest"), mfmap))
+            self.assertEqual(PackageIdentifier.parse_list(["a_2.0", "b_1.0", "c_1.0"]), keep_latest(mfmap))
+            self.assertEqual(PackageIdentifier.parse_list(["a_1.0", "a_1.10", "a_2.0"]), group_package_identifiers_by_name(mfmap)["a"])
+
+        # Versions are updated when the catalog is modified
+        del catalog[PackageIdentifier.parse("a_2.0")]
+        self.assertEqual(PackageIdentifier.parse("a_1.10"), catalog.latest("a"))
+        catalog.pop(PackageIdentifier.parse("b_1.0"))
+        self.assertEqual(["a", "c"], catalog.names())
+        catalog[PackageIdentifier.parse("b_2.0")] = "b_2.0"
+        self.assertEqual(PackageIdentifier.parse("b_2.0"), catalog.latest("b"))
+        self.assertEqual(catalog.versions("a"), catalog.copy().versions("a"))
+        catalog.clear()
+        self.assertEqual([], catalog.names())
+
     def test_variable_resolver(self):
 
         ip1 = InstalledPackage(TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST)
@@ -139,6 +172,33 @@ class TestMisc(LeafTestCase):
         with lf.acquire(advisory=advisory):
             pass
 
+    def test_lock_removed(self):
+        lf = LockFile(self.volatile_folder / "removed.lock")
+        acquired = Event()
+        release = Event()
+
+        def wait_lock():
+            with lf.acquire(advisory=False, blocking=True):
+                acquired.set()
+                release.wait(10)
+
+        with lf.acquire(advisory=False):
+            thread = Thread(target=wait_lock)
+            thread.start()
+            # Let the thread open the lock file and wait for it
+            time.sleep(0.5)
+            # The owner removes the lock file, the waiting thread locks the new one
+            lf.file.unlink()
+        try:
+            self.assertTrue(acquired.wait(10))
+            self.assertTrue(lf.file.exists())
+            with self.assertRaises(LeafException):
+                with lf.acquire(advisory=False):
+                    pass
+        finally:
+            release.set()
+            thread.join()
+
     def test_ap_candidates(self):
         remote_file = Remote("remote_file", {"url": "file:///tmp/file/index.json"})
         remote_fs = Remote("remote_fs", {"url": "/tmp/fs/index.json"})
@@ -183,3 +243,103 @@ class TestMisc(LeafTestCase):
 
         remote_custom.json["priority"] = 100
         self.assertEqual("https://foo.tld/custom/pack.leaf", ap.best_candidate.url)
+
+    def test_hash_methods(self):
+        file = TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST
+        sha384 = hash_compute(file)
+        blake2b = hash_compute(file, method="blake2b")
+        self.assertEqual([sha384, blake2b], hash_compute(file, methods=[None, "blake2b"]))
+        self.assertEqual(["sha384", 96], [hash_parse(sha384)[0], len(hash_parse(sha384)[1])])
+        self.assertEqual(["blake2b", 128], [hash_parse(blake2b)[0], len(hash_parse(blake2b)[1])])
+        # Verification dispatches on the method
+        self.assertTrue(hash_check(file, sha384))
+        self.assertTrue(hash_check(file, blake2b))
+        self.assertFalse(hash_check(file, "blake2b:" + "0" * 128))
+        with self.assertRaises(LeafException):
+            hash_parse("md5:" + "0" * 32)
+        with self.assertRaises(LeafException):
+            hash_parse("blake2b:" + "0" * 96)
+
+        # The fastest supported method is selected
+        self.assertEqual(blake2b, hash_select([sha384, blake2b]))
+        self.assertEqual(sha384, hash_select(["md5:" + "0" * 32, sha384]))
+        self.assertIsNone(hash_select([]))
+
+        ap_json = {"file": "pack.leaf", "hash": sha384}
+        ap_json["info"] = jloadfile(TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST)["info"]
+        self.assertEqual(sha384, AvailablePackage(ap_json).best_hashsum)
+        ap_json["hashes"] = [blake2b]
+        self.assertEqual([sha384, blake2b], AvailablePackage(ap_json).hashes)
+        self.assertEqual(sha384, AvailablePackage(ap_json).hashsum)
+        self.assertEqual(blake2b, AvailablePackage(ap_json).best_hashsum)
+
+    def test_fs_atomic_write(self):
+        folder = self.volatile_folder / "atomic"
+        folder.mkdir()
+        file = folder / "file.json"
+        jwritefile(file, {"a": 1}, atomic=True)
+        identity = fs_get_identity(file)
+        # Recent changes are not trusted, timestamps may be too coarse
+        self.assertTrue(fs_is_racy(identity))
+        past = time.time() - 3600
+        os.utime(str(file), (past, past))
+        self.assertFalse(fs_is_racy(fs_get_identity(file)))
+
+        # An interrupted write keeps the previous file
+        with self.assertRaises(ValueError):
+            with fs_atomic_write(file) as fp:
+                fp.write("foo")
+                raise ValueError()
+        self.assertEqual({"a": 1}, jloadfile(file))
+        self.assertEqual([file], list(folder.iterdir()))
+
+        # A replaced file has a new identity
+        jwritefile(file, {"a": 2}, atomic=True)
+        self.assertEqual({"a": 2}, jloadfile(file))
+        self.assertNotEqual(identity, fs_get_identity(file))
+        self.assertEqual([file], list(folder.iterdir()))
+
+    def test_http_session(self):
+        session = get_http_session()
+        self.assertIs(session, get_http_session())
+        for url in ("http://foo.tld/index.json", "https://foo.tld/index.json"):
+            self.assertIs(session.get_adapter(url), get_http_session().get_adapter(url))
+
+    def test_download_progress(self):
+        class CaptureLogger(TextLogger):
+            def __init__(self):
+                self.lines = []
+
+            def _print(self, *message, **kwargs):
+                self.lines.append(" ".join(message) + kwargs.get("end", "\n"))
+
+        # On a terminal, redraws are throttled and transfers share a single line
+        logger = CaptureLogger()
+        progress = DownloadProgress(logger, "Downloading", tty=True, interval=3600)
+        callbacks = [progress.create(i, 1024) for i in range(2)]
+        for worked in range(0, 1025, 64):
+            for callback in callbacks:
+                callback(worked, 1024)
+        progress.end()
+        self.assertEqual(2, len(logger.lines))
+        self.assertTrue(logger.lines[0].startswith("\r[0%] Downloading (0 bytes/2 kB)"))
+        self.assertFalse(logger.lines[0].endswith("\n"))
+        self.assertTrue(logger.lines[1].startswith("\r[100%] Downloading (2 kB/2 kB, "))
+        self.assertTrue(logger.lines[1].endswith("\n"))
+
+        # Otherwise, summary lines are printed periodically
+        logger = CaptureLogger()
+        progress = DownloadProgress(logger, "Downloading", tty=False, interval=0)
+        callback = progress.create("foo")
+        callback(512, 1024)
+        callback(1024, 1024)
+        progress.end()
+        self.assertEqual(3, len(logger.lines))
+        self.assertRegex(logger.lines[0], r"^\[50%\] Downloading \(512 bytes/1 kB, .*/s, ETA 0:00:\d\d\)\n$")
+        self.assertRegex(logger.lines[2], r"^\[100%\] Downloading \(1 kB/1 kB, .*/s\)\n$")
+
+        # No summary before the interval
+        logger = CaptureLogger()
+        progress = DownloadProgress(logger, "Downloading", tty=False)
+        progress.create("foo")(512, 1024)
+        self.assertEqual(0, len(logger.lines))